@@ -8,10 +8,42 @@ from gpiozero import Button
 
 from PIL import Image, ImageDraw, ImageFont
 
-from mpd import MPDClient
+from mpd import MPDClient, CommandError, MPDError
+
+from mpd import ConnectionError as MPDConnectionError
+
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor
+
+from contextlib import contextmanager
+
+from types import MappingProxyType
+
+from typing import NamedTuple, Optional
 
 import json
 
+import unicodedata
+
+from array import array
+
+import sqlite3
+
+from datetime import datetime, timezone
+
+import argparse
+
+import hashlib
+
+import numpy as np
+
+from io import BytesIO
+
+import heapq
+
+import itertools
+
 
 
 # グローバル変数
@@ -30,25 +62,226 @@ screen_off = False
 
 
 
-# GPIO設定
+# GPIO設定(init_buttons()で作成。アート事前生成モードではGPIOを使わない)
 
-button_action = Button(5)   # 決定
+button_action = None   # 決定 (GPIO 5)
 
-button_back = Button(6)      # 戻る
+button_back = None      # 戻る (GPIO 6)
 
-button_up = Button(16)       # 上/音量アップ
+LONG_PRESS_SECONDS = 0.6  # 上下ボタンの長押しで頭文字ジャンプ
 
-button_down = Button(20)     # 下/音量ダウン
+button_up = None       # 上/音量アップ (GPIO 16)
+
+button_down = None     # 下/音量ダウン (GPIO 20)
 
 
 
 # MPDクライアント
 
-mpd_client = MPDClient()
+MPD_HOST = "localhost"
+
+MPD_PORT = 6600
+
+# MPDのmusic_directory(このマシンから見える場合、フォルダ画像を直接読む)
+MUSIC_DIRECTORY = "/var/lib/mpd/music"
+
+# コマンドごとのタイムアウト(秒)。未指定のコマンドはMPD_DEFAULT_TIMEOUT
+MPD_DEFAULT_TIMEOUT = 5
+
+MPD_COMMAND_TIMEOUTS = {
+    'albumart': 30,
+    'readpicture': 30,
+    'listallinfo': 120,
+    'playlistinfo': 30,
+}
+
+# 切断時に再送してよいコマンド(読み取りと、値を直接指定する設定)。
+# add/move/deleteid/loadなどは処理済みで切断された場合に二重に実行されるので再送しない
+MPD_RETRYABLE_COMMANDS = frozenset({
+    'status', 'currentsong', 'stats', 'ping', 'playlistinfo', 'playlistid', 'plchanges',
+    'lsinfo', 'listall', 'listallinfo', 'listplaylists', 'listplaylistinfo', 'find', 'search',
+    'albumart', 'readpicture', 'play', 'setvol', 'random', 'repeat',
+})
+
+# この秒数以上使われていない接続は貸し出し前に死活確認する
+# (MPDのconnection_timeoutの既定値60秒より短くする)
+MPD_STALE_SECONDS = 45
+
+# この秒数を超えたコマンドはログに出す
+MPD_SLOW_COMMAND_SECONDS = 1.0
+
+
+class MPDConnectionPool:
+    """スレッドセーフなMPD接続プール
+
+    コマンドは呼び出しごとに空き接続を借りて実行するので、別スレッドの応答と
+    混ざることはなく、遅いコマンド(albumartなど)が他のコマンドを止めることもない。
+    複数のコマンドを同じ接続で続けて送る場合は connection() を使う。
+    """
+
+    def __init__(self, host, port, size=3):
+        self.host = host
+        self.port = port
+        self.size = size
+        self._idle = []  # 空き接続 [(client, 最終使用時刻)]
+        self._created = 0
+        self._cond = threading.Condition()
+        self._metrics = {}  # コマンド名 -> {'count', 'errors', 'total', 'max'}
+        self._metrics_lock = threading.Lock()
+        self.reconnects = 0
+
+    def _connect_client(self):
+        client = MPDClient()
+        client.timeout = MPD_DEFAULT_TIMEOUT
+        client.idletimeout = None
+        client.connect(self.host, self.port)
+        return client
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                if self._idle:
+                    client, last_used = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    client, last_used = None, None
+                    break
+                self._cond.wait()
+
+        try:
+            if client is None:
+                client = self._connect_client()
+            elif time.monotonic() - last_used > MPD_STALE_SECONDS:
+                try:
+                    client.ping()
+                except (MPDConnectionError, OSError):
+                    self._discard(client)
+                    client = self._connect_client()
+                    self.reconnects += 1
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+        return client
+
+    def _release(self, client, broken=False):
+        with self._cond:
+            if broken:
+                self._discard(client)
+                self._created -= 1
+            else:
+                self._idle.append((client, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, client):
+        try:
+            client.disconnect()
+        except:
+            pass
+
+    @contextmanager
+    def connection(self, timeout=MPD_DEFAULT_TIMEOUT, name=None):
+        """接続を1本借りる(コマンドリストなど複数コマンドを続けて送る場合に使う)
+
+        nameを指定すると、借りている間の所要時間をその名前で統計に記録する。
+        """
+        client = self._acquire()
+        broken = False
+        start = time.monotonic()
+        try:
+            client.timeout = timeout
+            yield client
+        except CommandError:
+            raise
+        except Exception:
+            # 通信エラーやタイムアウトの後は応答がずれるので接続を捨てる
+            broken = True
+            raise
+        finally:
+            if not broken:
+                client.timeout = MPD_DEFAULT_TIMEOUT
+            self._release(client, broken)
+            if name:
+                self._record(name, time.monotonic() - start, error=broken)
+
+    def execute(self, command, *args):
+        """コマンドを1つ実行する(再送してよいコマンドは、切断されていた場合に再接続して1回だけ再試行)"""
+        timeout = MPD_COMMAND_TIMEOUTS.get(command, MPD_DEFAULT_TIMEOUT)
+        for attempt in range(2):
+            start = time.monotonic()
+            try:
+                with self.connection(timeout) as client:
+                    result = getattr(client, command)(*args)
+            except MPDConnectionError as e:
+                # MPD側で閉じられた接続。コマンドが処理済みかは分からないので、
+                # 繰り返しても結果が同じコマンドだけ再送する
+                self._record(command, time.monotonic() - start, error=True)
+                if attempt == 0 and command in MPD_RETRYABLE_COMMANDS:
+                    self.reconnects += 1
+                    continue
+                raise
+            except Exception:
+                self._record(command, time.monotonic() - start, error=True)
+                raise
+            self._record(command, time.monotonic() - start)
+            return result
+
+    def __getattr__(self, command):
+        if command.startswith('_'):
+            raise AttributeError(command)
+        return lambda *args: self.execute(command, *args)
+
+    def _record(self, command, elapsed, error=False):
+        with self._metrics_lock:
+            m = self._metrics.setdefault(command, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            m['count'] += 1
+            m['total'] += elapsed
+            m['max'] = max(m['max'], elapsed)
+            if error:
+                m['errors'] += 1
+        if elapsed > MPD_SLOW_COMMAND_SECONDS:
+            print(f"Slow MPD command '{command}': {elapsed:.2f}s")
+
+    def metrics(self):
+        """コマンドごとの実行回数・エラー数・所要時間を返す"""
+        with self._metrics_lock:
+            return {name: dict(m) for name, m in self._metrics.items()}
+
+    def print_metrics(self):
+        """コマンドの統計を表示"""
+        for name, m in sorted(self.metrics().items()):
+            avg = m['total'] / m['count'] if m['count'] else 0
+            print(f"MPD {name}: count={m['count']} errors={m['errors']} "
+                  f"avg={avg * 1000:.1f}ms max={m['max'] * 1000:.1f}ms")
+        print(f"MPD reconnects: {self.reconnects}")
+
+    def close_all(self):
+        """空き接続をすべて切断"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+        for client, _ in idle:
+            try:
+                client.close()
+            except:
+                pass
+            self._discard(client)
+
+
+mpd_client = MPDConnectionPool(MPD_HOST, MPD_PORT)
 
-mpd_client.timeout = 10
+# idle待ち受け専用の接続(コマンド用の接続とは分ける)
+idle_client = MPDClient()
+idle_client.timeout = 10
+idle_client.idletimeout = None
 
-mpd_client.idletimeout = None
+# 購読するidleサブシステム
+MPD_IDLE_SUBSYSTEMS = ("player", "mixer", "playlist", "options", "database", "update", "stored_playlist")
+
+# idleイベントの購読者 [(サブシステムのfrozenset, コールバック)]
+mpd_event_handlers = []
 
 
 
@@ -56,16 +289,29 @@ mpd_client.idletimeout = None
 
 current_screen = "main_menu"  # main_menu, library, now_playing, queue
 
+# メインメニューの項目 (キー, 表示名)
+MAIN_MENU = [
+    ("library", "ライブラリ"),
+    ("artist", "アーティスト"),
+    ("albumartist", "アルバムアーティスト"),
+    ("genre", "ジャンル"),
+    ("search", "検索"),
+    ("now_playing", "再生中"),
+    ("queue", "再生キュー"),
+    ("shutdown", "シャットダウン"),
+    ("reboot", "再起動"),
+    ("screen_off", "消灯"),
+    ("wifi", "WiFi"),
+]
+
 menu_stack = []  # メニュー階層管理
 
 selected_index = 0
 
-library_path = ""  # 現在のライブラリパス
+library_path = ""  # 現在のライブラリパス(タグ別表示では (種類, タグの値, アルバム) のタプル)
 
 library_items = []
 
-queue_items = []
-
 action_menu_visible = False
 
 action_menu_items = []
@@ -80,7 +326,173 @@ moving_queue_item = False
 
 moving_item_index = -1
 
-title_scroll_offset = 0  # タイトルスクロール用オフセット
+marquee_start = None  # タイトルのスクロールを始めた時刻(スクロールしていなければNone)
+
+marquee_active = False  # 表示中のタイトルがスクロール中か(表示スレッドが更新する)
+
+current_song_id = None  # 再生中画面に表示している曲のsongid
+
+search_query = ""  # 検索画面で入力中の文字列
+
+search_char_index = 0  # 検索画面で選択中の文字(SEARCH_ALPHABETの添字)
+
+search_mode = "input"  # input: 文字入力, results: 結果の選択
+
+search_results = []  # 検索結果(ライブラリと同じ形式の項目)
+
+now_playing_woken = True  # 再生中画面の情報部分を次の更新で必ず描き直すか
+
+now_playing_second = None  # 再生中画面に最後に描いた再生位置(秒)
+
+now_playing_title = None  # 再生中画面に最後に描いたタイトル(変わったらスクロールを戻す)
+
+# 再生位置の補間用に最後に取得した再生状態と取得時刻(time.monotonic)
+playback_clock = (None, 0.0)
+
+# 再生中はこの秒数ごとにMPDから再取得して補間のずれを補正する
+DRIFT_CHECK_INTERVAL = 30
+
+
+
+class ScheduledJob:
+    """スケジューラに登録したジョブ"""
+
+    def __init__(self, name, callback, interval, priority, screen):
+        self.name = name
+        self.callback = callback
+        self.interval = interval  # 周期(秒)。Noneなら1回限り
+        self.priority = priority  # 同じ時刻なら小さいほど先に実行する
+        self.screen = screen      # この画面の表示中だけ動かす(Noneならいつでも)
+        self.deadline = None      # 次の実行時刻(Noneなら止まっている)
+
+
+class Scheduler:
+    """1つのタイマーヒープで周期ジョブと遅延ジョブを動かすスケジューラ
+
+    次の実行時刻が最も近いジョブまで眠り、ジョブがなければ起こされるまで眠る。
+    ジョブの関数は、次の実行までの秒数(今から)を返すとその時刻に、Noneを返すと
+    周期どおり(前回の予定時刻から)に、STOPを返すと止まる。screenを指定した
+    ジョブは別の画面の表示中は保留され、その画面に戻ったときにすぐ実行される。
+    """
+
+    STOP = "stop"
+
+    def __init__(self):
+        self._heap = []  # (実行時刻, 優先度, 通し番号, ジョブ)。取り消したものは実行時に読み飛ばす
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._suspended = {}  # 画面 -> 保留中のジョブのset
+        self.screen = None
+        self.paused = False
+        self.wakeups = 0
+        self.runs = 0
+
+    def pause(self):
+        """すべてのジョブを止める(予定は残り、resume()で遅れた分からすぐに再開する)"""
+        with self._cond:
+            self.paused = True
+
+    def resume(self):
+        """pause()で止めたジョブを再開する"""
+        with self._cond:
+            self.paused = False
+            self._cond.notify()
+
+    def add(self, name, callback, interval=None, priority=0, screen=None, delay=None):
+        """ジョブを登録する(delayを指定すればその秒数後に実行、なければ止まった状態)"""
+        job = ScheduledJob(name, callback, interval, priority, screen)
+        if delay is not None:
+            self.reschedule(job, delay)
+        return job
+
+    def run_soon(self, job, delay=0.0):
+        """ジョブを今からdelay秒後までに実行する(予定がそれより遅ければ前倒しする)"""
+        with self._cond:
+            deadline = time.monotonic() + delay
+            if job.deadline is None or deadline < job.deadline:
+                self._push(job, deadline)
+
+    def reschedule(self, job, delay):
+        """ジョブの実行を今からdelay秒後にする(予定があれば置き換える)"""
+        with self._cond:
+            self._push(job, time.monotonic() + delay)
+
+    def cancel(self, job):
+        """ジョブを止める"""
+        with self._cond:
+            job.deadline = None
+            self._suspended.get(job.screen, set()).discard(job)
+
+    def set_screen(self, screen):
+        """表示中の画面を切り替え、その画面の保留中のジョブを再開する"""
+        with self._cond:
+            if screen == self.screen:
+                return
+            self.screen = screen
+            now = time.monotonic()
+            for job in self._suspended.pop(screen, ()):
+                if job.deadline is None:
+                    self._push(job, now)
+
+    def _push(self, job, deadline):
+        self._suspended.get(job.screen, set()).discard(job)
+        job.deadline = deadline
+        heapq.heappush(self._heap, (deadline, job.priority, next(self._counter), job))
+        self._cond.notify()
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self.paused or not self._heap:
+                    # 止まっている間は起こされるまで一度も目覚めない
+                    self._cond.wait()
+                    self.wakeups += 1
+                    continue
+                deadline, _, _, job = self._heap[0]
+                if job.deadline != deadline:
+                    heapq.heappop(self._heap)  # 取り消し・変更済み
+                    continue
+                now = time.monotonic()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    self.wakeups += 1
+                    continue
+                heapq.heappop(self._heap)
+                job.deadline = None
+                if job.screen is not None and job.screen != self.screen:
+                    self._suspended.setdefault(job.screen, set()).add(job)
+                    continue
+                return job, deadline
+
+    def run(self):
+        """スケジューラのスレッド本体"""
+        while True:
+            job, deadline = self._next_job()
+            try:
+                result = job.callback()
+            except Exception as e:
+                print(f"Error in scheduled job '{job.name}': {e}")
+                result = None
+            self.runs += 1
+            if result == Scheduler.STOP or (result is None and job.interval is None):
+                continue
+            with self._cond:
+                if job.deadline is not None:
+                    continue  # 実行中に予定が入った
+                now = time.monotonic()
+                if result is None:
+                    # 周期ジョブは予定時刻を基準にし、遅れた分は飛ばす
+                    next_deadline = deadline + job.interval
+                    if next_deadline < now:
+                        next_deadline = now + job.interval
+                else:
+                    next_deadline = now + result
+                self._push(job, next_deadline)
+
+
+
+# 画面の更新や先読みなどの時間で動く処理はすべてこのスケジューラで動かす
+scheduler = Scheduler()
 
 
 
@@ -132,7 +544,7 @@ def toggle_wifi():
 
 def set_backlight(state):
 
-    """バックライトのON/OFF"""
+    """バックライトのON/OFF(消灯中はパネルをスリープさせ、タイマーと描画を止める)"""
 
     global screen_off
 
@@ -140,16 +552,32 @@ def set_backlight(state):
 
         if state:
 
+            # パネルのメモリは保持されているので、消灯前の画面がすぐに表示される
+
+            panel.wake()
+
             disp.set_backlight(1)
 
             screen_off = False
 
+            scheduler.resume()
+
+            # 再生位置の基準を最新にしてから、再生中画面の更新を再開する
+
+            catch_up_mpd_events()
+
+            wake_now_playing()
+
         else:
 
             disp.set_backlight(0)
 
             screen_off = True
 
+            scheduler.pause()
+
+            panel.sleep()
+
     except Exception as e:
 
         print(f"Error setting backlight: {e}")
@@ -196,826 +624,3433 @@ def reboot_system():
 
 
 
-def get_library_items(path=""):
+# 並べ替えキーの先頭に付ける頭文字グループ(この順に並ぶ)
+# 記号・数字、A〜Z、かなの各行、その他(読みのない漢字など)
+INITIAL_GROUPS = (["#"] + [chr(c) for c in range(ord("A"), ord("Z") + 1)]
+                  + list("あかさたなはまやらわ") + ["他"])
 
-    """ライブラリアイテムを取得"""
+# かなの各行の最初の文字(ひらがなの文字コード順。あ・や・わ行は小書き文字から始まる)
+KANA_ROW_STARTS = "ぁかさたなはまゃらゎ"
 
-    try:
 
-        items = []
+def fold_text(text):
 
-        result = mpd_client.lsinfo(path)
+    """並べ替え用に表記ゆれを畳み込む(全角/半角の統一、カタカナ→ひらがな、大文字小文字)"""
 
-        
+    text = unicodedata.normalize("NFKC", text)
 
-        for item in result:
+    # カタカナ(ァ〜ヶ)をひらがなに
+    text = ''.join(chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in text)
 
-            if 'directory' in item:
+    return text.casefold().strip()
 
-                items.append({
 
-                    'type': 'directory',
 
-                    'name': item['directory'].split('/')[-1],
+def initial_group(folded):
 
-                    'path': item['directory']
+    """畳み込んだ文字列の頭文字グループの番号(INITIAL_GROUPSの添字)"""
 
-                })
+    if not folded:
 
-            elif 'file' in item:
+        return 0
 
-                title = item.get('title', item['file'].split('/')[-1])
+    c = folded[0]
 
-                items.append({
+    if 'a' <= c <= 'z':
 
-                    'type': 'file',
+        return 1 + ord(c) - ord('a')
 
-                    'name': title,
+    if 'ぁ' <= c <= 'ゖ':
 
-                    'path': item['file'],
+        row = 0
 
-                    'artist': item.get('artist', ''),
+        for i, start in enumerate(KANA_ROW_STARTS):
 
-                    'album': item.get('album', '')
+            if c >= start:
 
-                })
+                row = i
 
-            elif 'playlist' in item:
+        return 27 + row
 
-                items.append({
+    if c.isalnum() and not c.isdigit():
 
-                    'type': 'playlist',
+        return len(INITIAL_GROUPS) - 1
 
-                    'name': item['playlist'],
+    return 0
 
-                    'path': item['playlist']
 
-                })
 
-        
+def sort_key(text, reading=None):
 
-        return items
+    """一覧の並べ替えキー(読みのタグがあれば読みを使い、頭文字グループ順→かな畳み込み順)"""
 
-    except Exception as e:
+    folded = fold_text(reading or text or '')
 
-        print(f"Error getting library items: {e}")
+    return chr(0x21 + initial_group(folded)) + folded
 
-        return []
 
 
+def sort_key_initial(key):
 
-def get_queue_items():
+    """並べ替えキーから頭文字の表示名を取り出す"""
 
-    """再生キューを取得"""
+    return INITIAL_GROUPS[ord(key[0]) - 0x21] if key else INITIAL_GROUPS[0]
 
-    try:
 
-        items = []
 
-        playlist = mpd_client.playlistinfo()
+class LibraryListing(list):
+    """ライブラリの一覧(項目のリスト)と頭文字グループの開始位置
 
-        
+    group_starts は同じ種類・同じ頭文字が続く区間の先頭の添字、group_of は
+    各項目の区間番号で、長押しでの頭文字ジャンプをO(1)で行うのに使う。
+    """
 
-        for item in playlist:
+    def __init__(self, items, sort=True):
+        if sort:
+            # ディレクトリ、曲、プレイリストの順に分け、ディレクトリとプレイリストは読み順に並べる。
+            # 曲はトラック順を崩さないよう受け取った順(ファイル順)のまま
+            type_order = {'directory': 0, 'group': 0, 'file': 1, 'playlist': 2}
+            for item in items:
+                if item['type'] != 'file':
+                    item['key'] = sort_key(item['name'])
+            items = sorted(items, key=lambda item: (type_order.get(item['type'], 3), item.get('key', '')))
+        super().__init__(items)
 
-            title = item.get('title', item['file'].split('/')[-1])
+        self.group_starts = []
+        self.group_of = array('I', bytes(4 * len(items)))
+        previous = None
+        for i, item in enumerate(items):
+            group = (item['type'], sort_key_initial(item['key'])) if 'key' in item else None
+            if group != previous or not self.group_starts:
+                self.group_starts.append(i)
+                previous = group
+            self.group_of[i] = len(self.group_starts) - 1
 
-            items.append({
+    def next_group(self, index):
+        """次の頭文字グループの先頭(なければ末尾)"""
+        group = self.group_of[index] + 1
+        return self.group_starts[group] if group < len(self.group_starts) else len(self) - 1
 
-                'id': item['id'],
+    def previous_group(self, index):
+        """今のグループの先頭、すでに先頭なら前のグループの先頭"""
+        group = self.group_of[index]
+        if self.group_starts[group] == index and group > 0:
+            group -= 1
+        return self.group_starts[group]
 
-                'pos': item['pos'],
 
-                'name': title,
 
-                'artist': item.get('artist', ''),
+class LRUCache:
+    """使用量(バイト数の見積もり)に上限を設けたスレッドセーフなLRUキャッシュ"""
 
-                'album': item.get('album', '')
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof  # 値のバイト数を見積もる関数
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
 
-            })
+    def __len__(self):
+        return len(self._data)
 
-        
+    def __contains__(self, key):
+        return key in self._data
 
-        return items
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
 
-    except Exception as e:
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._data[key] = (value, size)
+            self.bytes += size
+            # 上限を超えた分は古いものから捨てる
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self.bytes -= old_size
 
-        print(f"Error getting queue: {e}")
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            self.bytes -= entry[1]
+            return entry[0]
 
-        return []
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
 
 
+def estimate_items_size(items):
 
-def get_current_status():
+    """ディレクトリ一覧のメモリ使用量を大まかに見積もる"""
 
-    """現在の再生状態を取得"""
+    size = 64 + 8 * len(items)
 
-    try:
+    for item in items:
 
-        status = mpd_client.status()
+        # dict本体 + 文字列(日本語を含むので1文字あたり最大4バイトで見積もる)
 
-        current_song = mpd_client.currentsong()
+        size += 360 + sum(49 + 4 * len(v) for v in item.values() if isinstance(v, str))
 
-        
+    return size
 
-        return {
 
-            'state': status.get('state', 'stop'),
 
-            'elapsed': float(status.get('elapsed', 0)),
+# ディレクトリ一覧キャッシュの上限(バイト)
+LIBRARY_CACHE_BYTES = 8 * 1024 * 1024
 
-            'duration': float(status.get('duration', 0)),
+# パス -> get_library_items() の結果(呼び出し側で変更しないこと)
+library_cache = LRUCache(LIBRARY_CACHE_BYTES, estimate_items_size)
 
-            'volume': int(status.get('volume', 50)),
+# キャッシュを破棄するたびに増やす(破棄前に始まった先読みの結果を捨てるため)
+library_cache_epoch = 0
 
-            'repeat': status.get('repeat', '0') == '1',
+# 保存済みプレイリストの名前の一覧(Noneなら未取得)
+stored_playlists = None
 
-            'random': status.get('random', '0') == '1',
 
-            'title': current_song.get('title', ''),
 
-            'artist': current_song.get('artist', ''),
+def invalidate_library_cache(changed):
 
-            'album': current_song.get('album', ''),
+    """データベース更新やプレイリスト変更でディレクトリ一覧キャッシュを破棄"""
 
-            'file': current_song.get('file', '')
+    global library_cache_epoch, stored_playlists
 
-        }
+    library_cache_epoch += 1
 
-    except Exception as e:
+    if "stored_playlist" in changed:
 
-        print(f"Error getting status: {e}")
+        stored_playlists = None
 
-        return None
+    if changed & {"database", "update"}:
 
+        library_cache.clear()
 
+    elif "stored_playlist" in changed:
 
-def play_now(path, is_playlist=False):
+        # 保存済みプレイリストはルートの一覧にだけ現れる
 
-    """今すぐ再生"""
+        library_cache.pop("")
 
-    try:
 
-        mpd_client.clear()
 
-        if is_playlist:
+def fetch_library_items(path, client):
 
-            mpd_client.load(path)
+    """lsinfoでディレクトリの内容を取得して一覧用の項目に変換"""
 
-        else:
+    items = []
 
-            mpd_client.add(path)
+    result = client.lsinfo(path)
 
-        mpd_client.play(0)
+    
 
-    except Exception as e:
+    for item in result:
 
-        print(f"Error playing: {e}")
+        if 'directory' in item:
 
+            items.append({
 
+                'type': 'directory',
 
-def add_to_queue(path, is_playlist=False):
+                'name': item['directory'].split('/')[-1],
 
-    """キューの最後に追加"""
+                'path': item['directory']
 
-    try:
+            })
 
-        if is_playlist:
+        elif 'file' in item:
 
-            mpd_client.load(path)
+            title = tag_text(item, 'title', item['file'].split('/')[-1])
 
-        else:
+            items.append({
 
-            mpd_client.add(path)
+                'type': 'file',
 
-    except Exception as e:
+                'name': title,
 
-        print(f"Error adding to queue: {e}")
+                'path': item['file'],
 
+                'artist': tag_text(item, 'artist'),
 
+                'album': tag_text(item, 'album')
 
-def add_next(path, is_playlist=False):
+            })
 
-    """次に割込追加"""
+        elif 'playlist' in item:
 
-    try:
+            items.append({
 
-        status = mpd_client.status()
+                'type': 'playlist',
 
-        current_pos = int(status.get('song', -1))
+                'name': item['playlist'],
 
-        
+                'path': item['playlist']
 
-        if is_playlist:
+            })
 
-            mpd_client.load(path)
+    
 
-        else:
+    return items
 
-            mpd_client.add(path)
 
-        
 
-        # 最後に追加された曲を現在の次に移動
+def get_stored_playlists(client):
 
-        playlist = mpd_client.playlistinfo()
+    """保存済みプレイリストの名前の一覧(stored_playlistイベントまでキャッシュする)"""
 
-        if playlist:
+    global stored_playlists
 
-            last_pos = len(playlist) - 1
+    playlists = stored_playlists
 
-            mpd_client.move(last_pos, current_pos + 1)
+    if playlists is None:
 
-    except Exception as e:
+        epoch = library_cache_epoch
 
-        print(f"Error adding next: {e}")
+        playlists = [p['playlist'] for p in client.listplaylists()]
 
+        if epoch == library_cache_epoch:
 
+            stored_playlists = playlists
 
-def show_action_menu(item):
+    return playlists
 
-    """アクションメニューを表示"""
 
-    global action_menu_visible, action_menu_items, action_menu_index
 
-    
+def load_library_listing(path, client):
 
-    if current_screen == "library":
+    """ディレクトリの一覧を作る(索引ができていれば索引から、なければlsinfoで)"""
 
-        action_menu_items = ["今すぐ再生", "キューの最後に追加", "次に割込追加"]
+    if library_index.ready:
 
-    elif current_screen == "queue":
+        # ローカルの索引から取得(MPDがデータベース更新中でもMPDに問い合わせない)
 
-        action_menu_items = ["移動", "削除", "今すぐ再生"]
+        items = library_index.list_dir(path)
 
-    
+        if path == "":
 
-    action_menu_visible = True
+            # 保存済みプレイリストはデータベースの外にあるので、ルートにだけ加える
 
-    action_menu_index = 0
+            try:
 
+                names = get_stored_playlists(client)
 
+            except Exception as e:
 
-def handle_action_menu_selection():
+                print(f"Error getting stored playlists: {e}")
 
-    """アクションメニューの選択を処理"""
+                names = []
 
-    global action_menu_visible, moving_queue_item, moving_item_index
+            known = {item['path'] for item in items}
 
-    
+            items += [{'type': 'playlist', 'name': name, 'path': name} for name in names if name not in known]
 
-    action = action_menu_items[action_menu_index]
+    else:
 
-    
+        items = fetch_library_items(path, client)
 
-    if current_screen == "library":
+    return LibraryListing(items)
 
-        item = library_items[selected_index]
 
-        is_playlist = item['type'] == 'playlist'
 
-        
+def get_library_items(path=""):
 
-        if action == "今すぐ再生":
+    """ライブラリアイテムを取得(一覧はキャッシュし、同じディレクトリはMPDに問い合わせない)"""
 
-            play_now(item['path'], is_playlist)
+    items = library_cache.get(path)
 
-        elif action == "キューの最後に追加":
+    if items is not None:
 
-            add_to_queue(item['path'], is_playlist)
+        return items
 
-        elif action == "次に割込追加":
+    try:
 
-            add_next(item['path'], is_playlist)
+        if isinstance(path, tuple):
 
-    
+            # タグ別表示は索引で並べ替え済み(曲はトラック順のまま)
 
-    elif current_screen == "queue":
+            items = LibraryListing(get_tag_view_items(path), sort=False)
 
-        if selected_index < 2:  # シャッフル/リピート
+            library_cache.put(path, items)
 
-            return
+            return items
 
-        
+        items = load_library_listing(path, mpd_client)
 
-        item = queue_items[selected_index - 2]
+        library_cache.put(path, items)
 
-        
+        return items
 
-        if action == "移動":
+    except Exception as e:
 
-            moving_queue_item = True
+        print(f"Error getting library items: {e}")
 
-            moving_item_index = selected_index
+        return LibraryListing([])
 
-            action_menu_visible = False
 
-            return
 
-        elif action == "削除":
+def get_tag_view_items(path):
 
-            try:
+    """タグ別表示の一覧を索引から取得(path は (種類,) / (種類, 値) / (種類, 値, アルバム))"""
 
-                mpd_client.deleteid(item['id'])
+    if not library_index.ready:
 
-            except Exception as e:
+        return [{'type': 'message', 'name': "索引を作成中...", 'path': path}]
 
-                print(f"Error deleting: {e}")
+    view = path[0]
 
-        elif action == "今すぐ再生":
+    column = TAG_VIEWS[view][0]
 
-            try:
+    if len(path) == 1:
 
-                mpd_client.play(int(item['pos']))
+        return [{'type': 'group', 'name': name or "(不明)", 'path': (view, name), 'count': count, 'key': key}
 
-            except Exception as e:
+                for name, key, count in library_index.list_groups(column)]
 
-                print(f"Error playing: {e}")
+    if len(path) == 2:
 
-    
+        return [{'type': 'group', 'name': name or "(不明)", 'path': (view, path[1], name), 'count': count, 'key': key}
 
-    action_menu_visible = False
+                for name, key, count in library_index.list_groups(column + '_album', path[1])]
 
+    return [{'type': 'file', 'name': title, 'path': file, 'artist': artist, 'album': path[2]}
 
+            for file, title, artist in library_index.list_group_songs(column, path[1], path[2])]
 
-def handle_button_action(bt):
 
-    """アクションボタン処理"""
 
-    global current_screen, selected_index, library_path, library_items
+# カーソルがディレクトリにこの秒数留まったら中身を先読みする
+LIBRARY_PREFETCH_DWELL = 0.4
 
-    global menu_stack, action_menu_visible, action_menu_index
+# 先読みする前後の項目数(0ならカーソル位置のみ)
+LIBRARY_PREFETCH_NEIGHBOURS = 1
 
-    global last_button_time, button_click_count
+# 先読み専用の接続と1スレッドのワーカー(操作側のコマンドを待たせない)
+library_prefetch_client = MPDConnectionPool(MPD_HOST, MPD_PORT, size=1)
 
-    global moving_queue_item, moving_item_index, queue_items, screen_off
-    
-    global title_scroll_offset
+def lower_thread_priority():
 
-    
+    """呼び出したスレッドの優先度を下げる(Linuxではスレッド単位でniceを設定できる)"""
 
-    # 消灯中の場合は点灯のみ
+    try:
 
-    if screen_off:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
 
-        set_backlight(True)
+    except Exception as e:
 
-        update_display()
+        print(f"Error lowering thread priority: {e}")
 
-        return
 
-    
 
-    # 再生中画面でのシングルクリック→再生/停止
+library_prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="library-prefetch",
+                                               initializer=lower_thread_priority)
 
-    if current_screen == "now_playing": 
+library_prefetch_generation = 0  # カーソルが動くたびに増やし、古い先読みを取り消す
 
-        try:
+library_prefetch_futures = []
 
-            status = mpd_client.status()
 
-            if status['state'] == 'play':
 
-                mpd_client.pause()
-                title_scroll_offset = 0  # 停止時にスクロールをリセット
+def schedule_library_prefetch():
 
-            else:
+    """カーソル位置のディレクトリの先読みを予約(前の予約は取り消す)"""
 
-                mpd_client.play()
-                title_scroll_offset = 0  # 再生開始時にスクロールをリセット
+    global library_prefetch_generation, library_prefetch_futures
 
-        except Exception as e:
+    library_prefetch_generation += 1
 
-            print(f"Error toggling play: {e}")
+    scheduler.cancel(library_prefetch_job)
 
-        return
+    for future in library_prefetch_futures:
 
-    
+        future.cancel()
 
-    # キュー移動モード
+    library_prefetch_futures = []
 
-    if moving_queue_item:
+    if current_screen != "library" or action_menu_visible:
 
-        try:
+        return
 
-            item = queue_items[moving_item_index - 2]
+    scheduler.reschedule(library_prefetch_job, LIBRARY_PREFETCH_DWELL)
 
-            new_pos = selected_index - 2
 
-            if new_pos >= 0:
 
-                mpd_client.move(int(item['pos']), new_pos)
+def start_library_prefetch():
 
-        except Exception as e:
+    """カーソル位置(と前後)のディレクトリのうち未取得のものを先読みキューに入れる(スケジューラのジョブ)"""
 
-            print(f"Error moving: {e}")
+    global library_prefetch_futures
 
-        moving_queue_item = False
+    generation = library_prefetch_generation
 
-        moving_item_index = -1
+    items = library_items
 
-        update_display()
+    # カーソル位置を先に、近い順に並べる
+    order = [selected_index]
 
-        return
+    for d in range(1, LIBRARY_PREFETCH_NEIGHBOURS + 1):
 
-    
+        order += [selected_index + d, selected_index - d]
 
-    # アクションメニュー表示中
+    futures = []
 
-    if action_menu_visible:
+    for i in order:
 
-        handle_action_menu_selection()
+        if 0 <= i < len(items) and items[i]['type'] == 'directory' and items[i]['path'] not in library_cache:
 
-        update_display()
+            futures.append(library_prefetch_executor.submit(prefetch_library_dir, items[i]['path'], generation))
 
-        return
+    library_prefetch_futures = futures
 
-    
 
-    # メイン画面
 
-    if current_screen == "main_menu":
+# カーソルが止まってからLIBRARY_PREFETCH_DWELL秒後に先読みを始めるジョブ
+library_prefetch_job = scheduler.add("library-prefetch", start_library_prefetch, screen="library")
 
-        if selected_index == 0:  # ライブラリ
 
-            current_screen = "library"
 
-            library_path = ""
+def prefetch_library_dir(path, generation):
 
-            library_items = get_library_items(library_path)
+    """ディレクトリの内容を先読み専用の接続で取得してキャッシュに入れる"""
 
-            selected_index = 0
+    if generation != library_prefetch_generation or path in library_cache:
 
-        elif selected_index == 1:  # 再生中
+        return
 
-            current_screen = "now_playing"
-            title_scroll_offset = 0  # スクロールオフセットをリセット
+    epoch = library_cache_epoch
 
-        elif selected_index == 2:  # 再生キュー
+    try:
 
-            current_screen = "queue"
+        items = load_library_listing(path, library_prefetch_client)
 
-            queue_items = get_queue_items()
+    except Exception as e:
 
-            selected_index = 0
+        print(f"Error prefetching {path}: {e}")
 
-        elif selected_index == 3:  # シャットダウン
+        return
 
-            shutdown_system()
+    if epoch == library_cache_epoch:
+
+        library_cache.put(path, items)
+
+
+
+# ライブラリ索引(SQLite)の保存先
+LIBRARY_INDEX_PATH = os.path.join(directory, ".pmpdp", "library.db")
+
+# 差分更新で取りこぼさないよう、前回の更新時刻からこの秒数さかのぼって変更を探す
+LIBRARY_INDEX_MTIME_MARGIN = 24 * 60 * 60
+
+# 索引へはこの件数ずつまとめて書き込む
+LIBRARY_INDEX_BATCH = 1000
+
+# 索引の構造を変えたら増やす(古い索引は作り直す)
+LIBRARY_INDEX_VERSION = 4
+
+LIBRARY_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS songs (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    album TEXT NOT NULL,
+    albumartist TEXT NOT NULL,
+    genre TEXT NOT NULL,
+    titlesort TEXT NOT NULL,
+    artistsort TEXT NOT NULL,
+    albumsort TEXT NOT NULL,
+    albumartistsort TEXT NOT NULL,
+    track INTEGER,
+    disc INTEGER,
+    duration REAL,
+    mtime INTEGER
+);
+CREATE INDEX IF NOT EXISTS songs_dir ON songs (dir, path);
+CREATE INDEX IF NOT EXISTS songs_artist ON songs (artist, album, disc, track);
+CREATE INDEX IF NOT EXISTS songs_albumartist ON songs (albumartist, album, disc, track);
+CREATE INDEX IF NOT EXISTS songs_album ON songs (album, disc, track);
+CREATE INDEX IF NOT EXISTS songs_genre ON songs (genre, album);
+CREATE TABLE IF NOT EXISTS playlists (path TEXT PRIMARY KEY, dir TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS playlists_dir ON playlists (dir, path);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent, path);
+CREATE TABLE IF NOT EXISTS tag_groups (
+    view TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    sort_key TEXT NOT NULL,
+    songs INTEGER NOT NULL,
+    PRIMARY KEY (view, parent, name)
+);
+CREATE INDEX IF NOT EXISTS tag_groups_sorted ON tag_groups (view, parent, sort_key);
+"""
+
+# タグ別の表示: 一覧の種類 -> (分類に使うタグ, 読みのタグ, 表示名)
+# 各タグの下はアルバム、その下は曲の3階層(tag_groupsのviewは "<タグ>" と "<タグ>_album")
+TAG_VIEWS = {
+    'artist': ('artist', 'artistsort', "アーティスト"),
+    'albumartist': ('albumartist', 'albumartistsort', "アルバムアーティスト"),
+    'genre': ('genre', 'genre', "ジャンル"),
+}
+
+
+def parse_tag_number(value):
+
+    """'3/12' のようなトラック番号・ディスク番号を整数に変換"""
 
-            return
+    try:
 
-        elif selected_index == 4:  # 再起動
+        return int(str(value).split('/')[0])
 
-            reboot_system()
+    except ValueError:
 
-            return
+        return None
 
-        elif selected_index == 5:  # 消灯
 
-            set_backlight(False)
 
-            return
+def parse_mtime(value):
 
-        elif selected_index == 6:  # WiFi
+    """MPDのlast-modified(ISO 8601)をUNIX時刻に変換"""
 
-            toggle_wifi()
+    try:
 
-            update_display()
+        return int(datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp())
 
-            return
+    except (TypeError, ValueError):
 
-    
+        return None
 
-    # ライブラリ画面
 
-    elif current_screen == "library":
 
-        if selected_index < len(library_items):
+def song_row(song):
 
-            item = library_items[selected_index]
+    """listallinfo/findの1曲を索引の行に変換"""
 
-            
+    path = song['file']
 
-            if item['type'] == 'directory':
+    duration = song.get('duration', song.get('time'))
 
-                menu_stack.append((library_path, selected_index))
+    return (
+
+        path,
+
+        path.rsplit('/', 1)[0] if '/' in path else '',
+
+        tag_text(song, 'title', path.split('/')[-1]),
+
+        tag_text(song, 'artist'),
+
+        tag_text(song, 'album'),
+
+        tag_text(song, 'albumartist'),
+
+        tag_text(song, 'genre'),
+
+        tag_text(song, 'titlesort'),
+
+        tag_text(song, 'artistsort'),
+
+        tag_text(song, 'albumsort'),
+
+        tag_text(song, 'albumartistsort'),
+
+        parse_tag_number(song['track']) if 'track' in song else None,
+
+        parse_tag_number(song['disc']) if 'disc' in song else None,
+
+        float(duration) if duration else None,
+
+        parse_mtime(song.get('last-modified'))
+
+    )
+
+
+
+class LibraryIndex:
+    """MPDのデータベース全体のローカル索引(SQLite)
+
+    初回は listallinfo から作り、以降はMPDの db_update が変わったときだけ
+    変更された曲を modified-since で取得し、listall のパスとの差分で削除・移動を反映する。一覧・並べ替え・
+    件数はすべて索引への問い合わせで返すので、MPDが走査中でも遅くならない。
+    """
+
+    SONG_COLUMNS = ("path, dir, title, artist, album, albumartist, genre, "
+                    "titlesort, artistsort, albumsort, albumartistsort, track, disc, duration, mtime")
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.lock = threading.Lock()
+        self.ready = False  # 一度でも構築が完了していればTrue
+        self._updating = threading.Lock()
+        self._pending = False  # 更新中に次の更新が要求された
+        self._affected = None  # 更新中に値が変わったタグ {タグ: {値}}(Noneなら全体を作り直す)
+
+    def open(self):
+        """索引を開く(なければ作る)"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.create_function("sort_key", 2, sort_key, deterministic=True)
+            version = None
+            if self.db.execute("SELECT name FROM sqlite_master WHERE name = 'meta'").fetchone():
+                version = self._get_meta('version')
+            if version != str(LIBRARY_INDEX_VERSION):
+                # 古い構造の索引は捨てて作り直す
+                self.db.executescript("DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS songs; "
+                                      "DROP TABLE IF EXISTS playlists; DROP TABLE IF EXISTS dirs; "
+                                      "DROP TABLE IF EXISTS tag_groups;")
+                self.db.executescript(LIBRARY_INDEX_SCHEMA)
+                self._set_meta('version', LIBRARY_INDEX_VERSION)
+                self.db.commit()
+            self.ready = self._get_meta('db_update') is not None
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def update(self, client):
+        """MPDのデータベースに変化があれば索引を更新する(変化があればTrue)
+
+        別スレッドで更新中なら要求だけを残し、そのスレッドが更新を終えた後に
+        db_updateが変わらなくなるまで繰り返す。
+        """
+        self._pending = True
+        changed = False
+        while self._pending and self._updating.acquire(blocking=False):
+            try:
+                while self._pending:
+                    self._pending = False
+                    changed = self._update_once(client) or changed
+            finally:
+                self._updating.release()
+        return changed
+
+    def _update_once(self, client):
+        """索引を1回更新する(変化があればTrue)"""
+        stats = client.stats()
+        db_update = int(stats.get('db_update', 0))
+        with self.lock:
+            stored = self._get_meta('db_update')
+        if stored is not None and int(stored) == db_update:
+            return False
+
+        start = time.monotonic()
+        if stored is None:
+            self._affected = None
+            self._rebuild(client)
+        else:
+            self._affected = {column: set() for column, _, _ in TAG_VIEWS.values()}
+            self._update_since(client, int(stored) - LIBRARY_INDEX_MTIME_MARGIN)
+
+        with self.lock:
+            self._rebuild_dirs()
+            self._rebuild_groups(self._affected)
+            self._set_meta('db_update', db_update)
+            self.db.commit()
+            self.ready = True
+        print(f"Library index updated in {time.monotonic() - start:.1f}s")
+        return True
+
+    def _insert_songs(self, songs):
+        """曲(とディレクトリ内のプレイリスト)をまとめて書き込む(songsはイテレータでもよい)"""
+        batch = []
+        playlists = []
+        for song in songs:
+            if 'playlist' in song:
+                playlists.append(song['playlist'])
+            if 'file' not in song:
+                continue
+            batch.append(song_row(song))
+            if len(batch) >= LIBRARY_INDEX_BATCH:
+                self._write_rows(batch)
+                batch = []
+        if batch:
+            self._write_rows(batch)
+        if playlists:
+            self._write_playlists(playlists)
+
+    def _write_playlists(self, paths):
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO playlists (path, dir) VALUES (?, ?)",
+                                [(path, os.path.dirname(path)) for path in paths])
+
+    def _write_rows(self, rows):
+        with self.lock:
+            self._note_affected([row[0] for row in rows])
+            if self._affected is not None:
+                for column, values in self._affected.items():
+                    i = self.SONG_COLUMNS.split(', ').index(column)
+                    values.update(row[i] for row in rows)
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO songs ({self.SONG_COLUMNS}) "
+                f"VALUES ({', '.join('?' * len(self.SONG_COLUMNS.split(', ')))})",
+                rows)
+
+    def _note_affected(self, paths):
+        """書き換える曲の変更前のタグの値を、作り直す分類として記録する"""
+        if self._affected is None:
+            return
+        columns = list(self._affected)
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            marks = ', '.join('?' * len(chunk))
+            for row in self.db.execute(
+                    f"SELECT {', '.join(columns)} FROM songs WHERE path IN ({marks})", chunk):
+                for column, value in zip(columns, row):
+                    self._affected[column].add(value)
+
+    def _rebuild(self, client):
+        """全曲を取り直して作り直す(初回のみ)"""
+        with self.lock:
+            self.db.execute("DELETE FROM songs")
+            self.db.execute("DELETE FROM playlists")
+        # 6万曲規模でもメモリに載せきらないよう、結果を逐次読みながら書き込む
+        with client.connection(timeout=MPD_COMMAND_TIMEOUTS['listallinfo'], name='listallinfo') as raw:
+            raw.iterate = True
+            try:
+                self._insert_songs(raw.listallinfo())
+            finally:
+                raw.iterate = False
+
+    def _update_since(self, client, since):
+        """指定時刻以降に変更された曲を書き込み、曲の一覧との差分で削除・移動・追加漏れを直す"""
+        self._insert_songs(client.find("modified-since", str(max(0, since))))
+
+        # 名前の変更や移動では更新時刻が変わらず、曲数も変わらないことがあるので、
+        # パスだけのlistallと毎回突き合わせる
+        with client.connection(timeout=MPD_COMMAND_TIMEOUTS['listallinfo'], name='listall') as raw:
+            entries = raw.listall()
+        existing = {entry['file'] for entry in entries if 'file' in entry}
+        # ディレクトリ内のプレイリストはパスしか持たないので、listallの内容で置き換える
+        with self.lock:
+            self.db.execute("DELETE FROM playlists")
+            self.db.executemany("INSERT OR REPLACE INTO playlists (path, dir) VALUES (?, ?)",
+                                [(entry['playlist'], os.path.dirname(entry['playlist']))
+                                 for entry in entries if 'playlist' in entry])
+            indexed = {path for (path,) in self.db.execute("SELECT path FROM songs")}
+            removed = [path for path in indexed if path not in existing]
+            self._note_affected(removed)
+            self.db.executemany("DELETE FROM songs WHERE path = ?", [(path,) for path in removed])
+        # 古い更新時刻のまま追加された曲(rsync -a や cp -p)は modified-since に出てこない
+        missing = existing - indexed
+        if missing:
+            self._insert_songs(self._fetch_songs(client, missing))
+
+    def _fetch_songs(self, client, paths):
+        """指定した曲のタグを、曲のあるディレクトリごとにlsinfoで取得する"""
+        dirs = {}
+        for path in paths:
+            dirs.setdefault(os.path.dirname(path), set()).add(path)
+        songs = []
+        with client.connection(name='lsinfo') as raw:
+            for song_dir, wanted in dirs.items():
+                songs += [entry for entry in raw.lsinfo(song_dir) if entry.get('file') in wanted]
+        return songs
+
+    def _rebuild_dirs(self):
+        """曲やプレイリストのあるディレクトリとその親ディレクトリの一覧を作り直す"""
+        dirs = set()
+        for (path,) in self.db.execute("SELECT dir FROM songs UNION SELECT dir FROM playlists"):
+            while path and path not in dirs:
+                dirs.add(path)
+                path = path.rsplit('/', 1)[0] if '/' in path else ''
+        self.db.execute("DELETE FROM dirs")
+        self.db.executemany("INSERT INTO dirs (path, parent) VALUES (?, ?)",
+                            [(d, d.rsplit('/', 1)[0] if '/' in d else '') for d in dirs])
+
+    def _rebuild_groups(self, affected):
+        """タグ別の分類(タグ -> アルバム)を作り直す(affectedがNoneなら全体)"""
+        for column, reading, _ in TAG_VIEWS.values():
+            album_view = column + '_album'
+            if affected is None:
+                self.db.execute("DELETE FROM tag_groups WHERE view IN (?, ?)", (column, album_view))
+                where, values = "", [()]
+            else:
+                values = [(value,) for value in affected[column]]
+                self.db.executemany("DELETE FROM tag_groups WHERE view = ? AND parent = '' AND name = ?",
+                                    [(column, value) for (value,) in values])
+                self.db.executemany("DELETE FROM tag_groups WHERE view = ? AND parent = ?",
+                                    [(album_view, value) for (value,) in values])
+                where = f"WHERE {column} = ?"
+            self.db.executemany(
+                f"INSERT INTO tag_groups (view, parent, name, sort_key, songs) "
+                f"SELECT '{column}', '', {column}, sort_key({column}, MAX({reading})), COUNT(*) "
+                f"FROM songs {where} GROUP BY {column}", values)
+            self.db.executemany(
+                f"INSERT INTO tag_groups (view, parent, name, sort_key, songs) "
+                f"SELECT '{album_view}', {column}, album, sort_key(album, MAX(albumsort)), COUNT(*) "
+                f"FROM songs {where} GROUP BY {column}, album", values)
+
+    def list_groups(self, view, parent=''):
+        """分類の一覧を並べ替え済みで返す [(名前, 並べ替えキー, 曲数)]"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT name, sort_key, songs FROM tag_groups WHERE view = ? AND parent = ? ORDER BY sort_key, name",
+                (view, parent)).fetchall()
+
+    def list_group_songs(self, column, value, album):
+        """タグとアルバムが一致する曲をディスク・トラック順に返す [(パス, タイトル, アーティスト)]"""
+        if column not in ('artist', 'albumartist', 'genre'):
+            raise ValueError(column)
+        with self.lock:
+            return self.db.execute(
+                f"SELECT path, title, artist FROM songs WHERE {column} = ? AND album = ? "
+                f"ORDER BY disc, track, path", (value, album)).fetchall()
+
+    def list_dir(self, path):
+        """ディレクトリの内容をlsinfoと同じ形式で返す(ディレクトリ、曲、プレイリストの順)"""
+        with self.lock:
+            subdirs = self.db.execute(
+                "SELECT path FROM dirs WHERE parent = ? ORDER BY path", (path,)).fetchall()
+            songs = self.db.execute(
+                "SELECT path, title, artist, album FROM songs WHERE dir = ? ORDER BY path",
+                (path,)).fetchall()
+            playlists = self.db.execute(
+                "SELECT path FROM playlists WHERE dir = ? ORDER BY path", (path,)).fetchall()
+        items = [{'type': 'directory', 'name': d.split('/')[-1], 'path': d} for (d,) in subdirs]
+        items += [{'type': 'file', 'name': title, 'path': file, 'artist': artist, 'album': album}
+                  for file, title, artist, album in songs]
+        items += [{'type': 'playlist', 'name': p, 'path': p} for (p,) in playlists]
+        return items
+
+
+library_index = LibraryIndex(LIBRARY_INDEX_PATH)
+
+# 索引の更新専用の接続(listallinfoなどの長いコマンドで操作側を待たせない)
+library_index_client = MPDConnectionPool(MPD_HOST, MPD_PORT, size=1)
+
+
+
+def update_library_index():
+
+    """索引を更新し、内容が変わっていればディレクトリ一覧キャッシュを破棄"""
+
+    try:
+
+        if library_index.update(library_index_client):
+
+            invalidate_library_cache({"database"})
+
+            invalidate_search_index()
+
+    except Exception as e:
+
+        print(f"Error updating library index: {e}")
+
+
+
+def schedule_library_index_update(changed=None):
+
+    """索引の更新をバックグラウンドで開始"""
+
+    thread = threading.Thread(target=update_library_index)
+
+    thread.daemon = True
+
+    thread.start()
+
+
+
+# 検索画面で上下ボタンで選ぶ文字。行ごとに並べ、長押しで行を移動する
+SEARCH_ALPHABET_ROWS = [
+    "ABCDEFGHIJKLM",
+    "NOPQRSTUVWXYZ",
+    "0123456789",
+    "あいうえお", "かきくけこ", "さしすせそ", "たちつてと", "なにぬねの",
+    "はひふへほ", "まみむめも", "やゆよ", "らりるれろ", "わをんー",
+    "がぎぐげご", "ざじずぜぞ", "だぢづでど", "ばびぶべぼ", "ぱぴぷぺぽ",
+    "ぁぃぅぇぉっゃゅょ",
+    " ",
+]
+
+SEARCH_ALPHABET = ''.join(SEARCH_ALPHABET_ROWS)
+
+# 各行の先頭の添字
+SEARCH_ROW_STARTS = [sum(len(row) for row in SEARCH_ALPHABET_ROWS[:i]) for i in range(len(SEARCH_ALPHABET_ROWS))]
+
+# 検索結果として表示する最大件数
+SEARCH_MAX_RESULTS = 300
+
+
+class SearchIndex:
+    """タイトル・アーティスト・アルバムのメモリ上の検索索引
+
+    全曲の畳み込み済み文字列を1本の文字列に連結して添字(array)で区切り、
+    1文字の検索は単語の先頭文字の索引、2文字以上は文字2-gramの出現曲の
+    リスト(array)のうち最も短いものを候補にして部分一致を確かめる。
+    入力を1文字足しただけなら前回の結果を絞り込むだけで済ませる。
+    """
+
+    def __init__(self, rows):
+        texts = []
+        self.paths = []
+        self.names = []
+        self.prefixes = {}  # 文字 -> その文字で始まる単語を含む曲
+        self.grams = {}  # 2文字 -> それを含む曲
+        for song_id, (path, title, artist, album) in enumerate(rows):
+            text = fold_text(f"{title}\n{artist}\n{album}")
+            texts.append(text)
+            self.paths.append(path)
+            self.names.append(title)
+            for word in text.split():
+                self._post(self.prefixes, word[0], song_id)
+            for i in range(len(text) - 1):
+                gram = text[i:i + 2]
+                if '\n' not in gram:
+                    self._post(self.grams, gram, song_id)
+        self.offsets = array('I', [0])
+        for text in texts:
+            self.offsets.append(self.offsets[-1] + len(text) + 1)
+        self.text = '\0'.join(texts) + '\0'
+        self._last_query = None
+        self._last_ids = None
+
+    @staticmethod
+    def _post(postings, key, song_id):
+        ids = postings.get(key)
+        if ids is None:
+            postings[key] = array('I', [song_id])
+        elif ids[-1] != song_id:
+            ids.append(song_id)
+
+    def _text_of(self, song_id):
+        return self.text[self.offsets[song_id]:self.offsets[song_id + 1] - 1]
+
+    def search(self, query):
+        """部分一致で検索し、一致した曲の番号を返す"""
+        query = fold_text(query)
+        if not query:
+            return []
+        if self._last_query and query.startswith(self._last_query) and len(self._last_query) > 1:
+            # 前回の結果を絞り込む
+            candidates = self._last_ids
+        elif len(query) == 1:
+            candidates = self.prefixes.get(query, ())
+        else:
+            postings = [self.grams.get(query[i:i + 2], ()) for i in range(len(query) - 1)]
+            candidates = min(postings, key=len)
+        if len(query) == 1:
+            ids = list(candidates)
+        else:
+            ids = [song_id for song_id in candidates if query in self._text_of(song_id)]
+        self._last_query, self._last_ids = query, ids
+        return ids
+
+    def items(self, ids, limit=SEARCH_MAX_RESULTS):
+        """曲の番号をライブラリと同じ形式の項目に変換"""
+        return [{'type': 'file', 'name': self.names[i], 'path': self.paths[i]} for i in ids[:limit]]
+
+
+search_index = None
+
+search_index_building = False
+
+search_index_stale = False  # ライブラリ索引が更新され、作り直しが必要(作り直すまでは古い索引で検索する)
+
+search_index_lock = threading.Lock()
+
+
+
+def build_search_index():
+
+    """ライブラリ索引から検索索引を作る(初回の検索画面表示時にバックグラウンドで実行)"""
+
+    global search_index, search_index_building, search_index_stale
+
+    with search_index_lock:
+
+        search_index_stale = False
+
+    try:
+
+        start = time.monotonic()
+
+        with library_index.lock:
+
+            rows = library_index.db.execute("SELECT path, title, artist, album FROM songs ORDER BY path").fetchall()
+
+        search_index = SearchIndex(rows)
+
+        print(f"Search index built in {time.monotonic() - start:.1f}s ({len(rows)} songs)")
+
+    except Exception as e:
+
+        print(f"Error building search index: {e}")
+
+    finally:
+
+        with search_index_lock:
+
+            search_index_building = False
+
+    if current_screen == "search":
+
+        # 作成中にまた更新されていれば続けて作り直す
+
+        if search_index_stale:
+
+            ensure_search_index()
+
+        update_search_results()
+
+        update_display()
+
+
+
+def ensure_search_index():
+
+    """検索索引がないか古ければ作成を開始する"""
+
+    global search_index_building
+
+    with search_index_lock:
+
+        if (search_index is not None and not search_index_stale) or search_index_building or not library_index.ready:
+
+            return
+
+        search_index_building = True
+
+    thread = threading.Thread(target=build_search_index)
+
+    thread.daemon = True
+
+    thread.start()
+
+
+
+def invalidate_search_index():
+
+    """ライブラリ索引が更新されたら検索索引を古いものとする
+
+    新しい索引ができるまでは古い索引で検索を続ける。検索画面を表示中ならすぐに作り直し、
+    それ以外は次の検索画面表示時に作り直す。
+    """
+
+    global search_index_stale
+
+    with search_index_lock:
+
+        search_index_stale = True
+
+    if current_screen == "search":
+
+        ensure_search_index()
+
+
+
+def update_search_results():
+
+    """入力中の文字列で検索結果を更新"""
+
+    global search_results
+
+    if search_index is None or not search_query.strip():
+
+        search_results = []
+
+        return
+
+    start = time.monotonic()
+
+    ids = search_index.search(search_query)
+
+    search_results = search_index.items(ids)
+
+    elapsed = time.monotonic() - start
+
+    if elapsed > 0.05:
+
+        print(f"Slow search '{search_query}': {elapsed * 1000:.0f}ms ({len(ids)} hits)")
+
+
+
+def queue_entry(item):
+
+    """playlistinfo/plchangesの1件をキュー画面用の項目に変換"""
+
+    return {
+
+        'id': item['id'],
+
+        'pos': item['pos'],
+
+        'name': tag_text(item, 'title', item['file'].split('/')[-1]),
+
+        'artist': tag_text(item, 'artist'),
+
+        'album': tag_text(item, 'album')
+
+    }
+
+
+
+# キューはこの件数ずつのページ単位で取得する
+QUEUE_PAGE_SIZE = 64
+
+# 表示中のページの前後何ページまでを保持するか(それ以外は破棄する)
+QUEUE_PAGE_WINDOW = 2
+
+
+class QueueMirror:
+    """MPDの再生キューのローカルな写し
+
+    キュー全体は持たず、表示位置の周辺のページだけを playlistinfo start:end で
+    取得して保持する。隣のページはバックグラウンドで先読みし、離れたページは
+    破棄するので、キューの長さに関係なく開く時間とメモリ使用量は一定になる。
+    MPDのplaylistバージョンが変わったときは、保持しているページの範囲だけ
+    plchangesposid の差分を適用する。
+    """
+
+    def __init__(self):
+        self.version = None  # 最後に同期したplaylistバージョン
+        self.length = 0
+        self.pages = {}  # ページ番号 -> 項目のリスト
+        self.lock = threading.RLock()
+        self._prefetch_cond = threading.Condition(self.lock)
+        self._prefetch_wanted = []
+        self._prefetch_thread = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        page_no = index // QUEUE_PAGE_SIZE
+        with self.lock:
+            page = self.pages.get(page_no)
+            if page is None:
+                page = self._fetch_page(page_no)
+                if page is not None:
+                    self.pages[page_no] = page
+            self._evict(page_no)
+            self._request_prefetch(page_no)
+        offset = index - page_no * QUEUE_PAGE_SIZE
+        if page is None or offset >= len(page):
+            # 取得に失敗した場合の仮の項目
+            return {'id': None, 'pos': str(index), 'name': '...', 'artist': '', 'album': ''}
+        return page[offset]
+
+    def _page_range(self, page_no):
+        start = page_no * QUEUE_PAGE_SIZE
+        return start, min(self.length, start + QUEUE_PAGE_SIZE)
+
+    def _fetch_page(self, page_no):
+        start, end = self._page_range(page_no)
+        if start >= end:
+            return None
+        try:
+            return [queue_entry(item) for item in mpd_client.playlistinfo(f"{start}:{end}")]
+        except Exception as e:
+            print(f"Error getting queue page {page_no}: {e}")
+            return None
+
+    def _evict(self, page_no):
+        for old in [n for n in self.pages if abs(n - page_no) > QUEUE_PAGE_WINDOW]:
+            del self.pages[old]
+
+    def _request_prefetch(self, page_no):
+        last_page = (self.length - 1) // QUEUE_PAGE_SIZE
+        wanted = [n for n in (page_no + 1, page_no - 1)
+                  if 0 <= n <= last_page and n not in self.pages]
+        if not wanted:
+            return
+        self._prefetch_wanted = wanted
+        if self._prefetch_thread is None:
+            self._prefetch_thread = threading.Thread(target=self._prefetch_loop)
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+        self._prefetch_cond.notify()
+
+    def _prefetch_loop(self):
+        """隣接ページを1つずつ先読みする(接続を占有しないよう同時に1件まで)"""
+        while True:
+            with self.lock:
+                while not self._prefetch_wanted:
+                    self._prefetch_cond.wait()
+                page_no = self._prefetch_wanted.pop(0)
+                if page_no in self.pages:
+                    continue
+                version = self.version
+                start, end = self._page_range(page_no)
+            if start >= end:
+                continue
+            try:
+                items = mpd_client.playlistinfo(f"{start}:{end}")
+            except Exception as e:
+                print(f"Error prefetching queue page {page_no}: {e}")
+                continue
+            with self.lock:
+                # 取得中にキューが変わっていたら捨てる
+                if version == self.version and page_no not in self.pages:
+                    self.pages[page_no] = [queue_entry(item) for item in items]
+
+    def sync(self, status=None):
+        """MPDと同期する(statusは取得済みのスナップショットがあれば渡す)"""
+        try:
+            with self.lock:
+                if status is None:
+                    status = get_current_status()
+                if status is None or status.playlist_version is None:
+                    return
+                if status.playlist_version == self.version:
+                    return
+
+                old_version = self.version
+                self.version = status.playlist_version
+                self.length = status.playlist_length
+                if old_version is None or status.playlist_version < old_version:
+                    # 初回またはMPD再起動でバージョンが巻き戻った場合は保持ページを破棄
+                    self.pages = {}
+                else:
+                    self._apply_changes(old_version)
+        except Exception as e:
+            print(f"Error syncing queue: {e}")
+            self.pages = {}
+
+    def _apply_changes(self, version):
+        """保持しているページの範囲だけ差分を適用する"""
+        for page_no in list(self.pages):
+            if self._page_range(page_no)[0] >= self.length:
+                del self.pages[page_no]
+        if not self.pages:
+            return
+
+        page_nos = sorted(self.pages)
+        with mpd_client.connection(name='plchangesposid_batch') as client:
+            client.command_list_ok_begin()
+            for page_no in page_nos:
+                start, end = self._page_range(page_no)
+                client.plchangesposid(version, f"{start}:{end}")
+            results = client.command_list_end()
+
+        known = {}
+        for page in self.pages.values():
+            for item in page:
+                known[item['id']] = item
+
+        for page_no, changes in zip(page_nos, results):
+            start, end = self._page_range(page_no)
+            page = self.pages[page_no][:end - start]
+            for change in changes:
+                pos = int(change['cpos'])
+                item = known.get(change['id'])
+                if item is None or pos - start >= len(page) + 1:
+                    # 保持していない曲が入ってきたページは次の表示時に取り直す
+                    page = None
+                    break
+                if pos - start == len(page):
+                    page.append(dict(item, pos=str(pos)))
+                else:
+                    page[pos - start] = dict(item, pos=str(pos))
+            if page is None or len(page) != end - start:
+                del self.pages[page_no]
+            else:
+                self.pages[page_no] = page
+
+
+queue_mirror = QueueMirror()
+
+
+
+class PlayerStatus(NamedTuple):
+    """再生状態のスナップショット(1フレームの描画内で共有する)"""
+    state: str
+    elapsed: float
+    duration: float
+    volume: int
+    repeat: bool
+    random: bool
+    songid: Optional[str]
+    song_pos: int
+    nextsongid: Optional[str]
+    playlist_version: Optional[int]
+    playlist_length: int
+    title: str
+    artist: str
+    album: str
+    albumartist: str
+    file: str
+    last_modified: Optional[int]  # 曲ファイルの更新時刻(アルバムアートのキャッシュの確認に使う)
+    next_song: Optional[MappingProxyType]  # include_next=True のときの次の曲のタグ
+
+
+def tag_text(song, key, default=''):
+    """タグの値を文字列で取得(複数値のタグは先頭を使う)"""
+    value = song.get(key, default)
+    if isinstance(value, list):
+        value = value[0] if value else default
+    return value
+
+
+def get_current_status(include_next=False):
+    """現在の再生状態を取得(statusとcurrentsongを1回のコマンドリストで取得)"""
+
+    try:
+
+        with mpd_client.connection(name='status_snapshot') as client:
+            client.command_list_ok_begin()
+            client.status()
+            client.currentsong()
+            status, current_song = client.command_list_end()
+
+            next_song = None
+            if include_next and 'nextsongid' in status:
+                found = client.playlistid(status['nextsongid'])
+                if found:
+                    next_song = MappingProxyType(found[0])
+
+        duration = status.get('duration', status.get('time', '0:0').split(':')[-1])
+
+        snapshot = PlayerStatus(
+
+            state=status.get('state', 'stop'),
+
+            elapsed=float(status.get('elapsed', 0)),
+
+            duration=float(duration),
+
+            volume=int(status.get('volume', 50)),
+
+            repeat=status.get('repeat', '0') == '1',
+
+            random=status.get('random', '0') == '1',
+
+            songid=status.get('songid'),
+
+            song_pos=int(status.get('song', -1)),
+
+            nextsongid=status.get('nextsongid'),
+
+            playlist_version=int(status['playlist']) if 'playlist' in status else None,
+
+            playlist_length=int(status.get('playlistlength', 0)),
+
+            title=tag_text(current_song, 'title'),
+
+            artist=tag_text(current_song, 'artist'),
+
+            album=tag_text(current_song, 'album'),
+
+            albumartist=tag_text(current_song, 'albumartist'),
+
+            file=current_song.get('file', ''),
+
+            last_modified=parse_mtime(current_song.get('last-modified')),
+
+            next_song=next_song
+
+        )
+
+        sync_playback_clock(snapshot)
+
+        return snapshot
+
+    except Exception as e:
+
+        print(f"Error getting status: {e}")
+
+        return None
+
+
+
+def sync_playback_clock(status):
+
+    """取得した再生状態を再生位置の補間の基準にする"""
+
+    global playback_clock
+
+    playback_clock = (status, time.monotonic())
+
+
+
+def interpolated_elapsed():
+
+    """最後に取得した状態と経過時間から現在の再生位置を計算(MPDに問い合わせない)"""
+
+    status, synced_at = playback_clock
+
+    if status is None:
+
+        return 0.0
+
+    if status.state != 'play':
+
+        return status.elapsed
+
+    elapsed = status.elapsed + (time.monotonic() - synced_at)
+
+    if status.duration:
+
+        elapsed = min(elapsed, status.duration)
+
+    return elapsed
+
+
+
+def play_now(path, is_playlist=False):
+
+    """今すぐ再生"""
+
+    try:
+
+        mpd_client.clear()
+
+        if is_playlist:
+
+            mpd_client.load(path)
+
+        else:
+
+            mpd_client.add(path)
+
+        mpd_client.play(0)
+
+    except Exception as e:
+
+        print(f"Error playing: {e}")
+
+
+
+def add_to_queue(path, is_playlist=False):
+
+    """キューの最後に追加"""
+
+    try:
+
+        if is_playlist:
+
+            mpd_client.load(path)
+
+        else:
+
+            mpd_client.add(path)
+
+    except Exception as e:
+
+        print(f"Error adding to queue: {e}")
+
+
+
+def add_next(path, is_playlist=False):
+
+    """次に割込追加"""
+
+    try:
+
+        status = mpd_client.status()
+
+        current_pos = int(status.get('song', -1))
+
+        old_length = int(status.get('playlistlength', 0))
+
+        
+
+        if is_playlist:
+
+            mpd_client.load(path)
+
+        else:
+
+            mpd_client.add(path)
+
+        
+
+        # 追加された曲(キューの末尾)をまとめて現在の次に移動
+
+        new_length = int(mpd_client.status().get('playlistlength', 0))
+
+        if new_length > old_length:
+
+            mpd_client.move(f"{old_length}:{new_length}", current_pos + 1)
+
+    except Exception as e:
+
+        print(f"Error adding next: {e}")
+
+
+
+def show_action_menu(item):
+
+    """アクションメニューを表示"""
+
+    global action_menu_visible, action_menu_items, action_menu_index
+
+    
+
+    if current_screen in ("library", "search"):
+
+        action_menu_items = ["今すぐ再生", "キューの最後に追加", "次に割込追加"]
+
+    elif current_screen == "queue":
+
+        action_menu_items = ["移動", "削除", "今すぐ再生"]
+
+    
+
+    action_menu_visible = True
+
+    action_menu_index = 0
+
+
+
+def handle_action_menu_selection():
+
+    """アクションメニューの選択を処理"""
+
+    global action_menu_visible, moving_queue_item, moving_item_index, selected_index
+
+    
+
+    action = action_menu_items[action_menu_index]
+
+    
+
+    if current_screen in ("library", "search"):
+
+        item = library_items[selected_index] if current_screen == "library" else search_results[selected_index]
+
+        is_playlist = item['type'] == 'playlist'
+
+        
+
+        if action == "今すぐ再生":
+
+            play_now(item['path'], is_playlist)
+
+        elif action == "キューの最後に追加":
+
+            add_to_queue(item['path'], is_playlist)
+
+        elif action == "次に割込追加":
+
+            add_next(item['path'], is_playlist)
+
+    
+
+    elif current_screen == "queue":
+
+        if selected_index < 2:  # シャッフル/リピート
+
+            return
+
+        
+
+        item = queue_mirror[selected_index - 2]
+
+        
+
+        if action == "移動":
+
+            moving_queue_item = True
+
+            moving_item_index = selected_index
+
+            action_menu_visible = False
+
+            return
+
+        elif action == "削除":
+
+            try:
+
+                mpd_client.deleteid(item['id'])
+
+            except Exception as e:
+
+                print(f"Error deleting: {e}")
+
+            queue_mirror.sync()
+
+            selected_index = min(selected_index, len(queue_mirror) + 1)
+
+        elif action == "今すぐ再生":
+
+            try:
+
+                mpd_client.play(int(item['pos']))
+
+            except Exception as e:
+
+                print(f"Error playing: {e}")
+
+    
+
+    action_menu_visible = False
+
+
+
+def handle_button_action(bt):
+
+    """アクションボタン処理"""
+
+    global current_screen, selected_index, library_path, library_items
+
+    global menu_stack, action_menu_visible, action_menu_index
+
+    global last_button_time, button_click_count
+
+    global moving_queue_item, moving_item_index, screen_off
+    
+    global marquee_start
+
+    global search_query, search_mode
+
+    
+
+    # 消灯中の場合は点灯のみ
+
+    if screen_off:
+
+        set_backlight(True)
+
+        update_display()
+
+        return
+
+    
+
+    # 再生中画面でのシングルクリック→再生/停止
+
+    if current_screen == "now_playing": 
+
+        try:
+
+            status = mpd_client.status()
+
+            if status['state'] == 'play':
+
+                mpd_client.pause()
+                marquee_start = None  # 停止時にスクロールをリセット
+
+            else:
+
+                mpd_client.play()
+                marquee_start = None  # 再生開始時にスクロールをリセット
+
+        except Exception as e:
+
+            print(f"Error toggling play: {e}")
+
+        return
+
+    
+
+    # キュー移動モード
+
+    if moving_queue_item:
+
+        try:
+
+            item = queue_mirror[moving_item_index - 2]
+
+            new_pos = selected_index - 2
+
+            if new_pos >= 0:
+
+                mpd_client.move(int(item['pos']), new_pos)
+
+        except Exception as e:
+
+            print(f"Error moving: {e}")
+
+        queue_mirror.sync()
+
+        moving_queue_item = False
+
+        moving_item_index = -1
+
+        update_display()
+
+        return
+
+    
+
+    # アクションメニュー表示中
+
+    if action_menu_visible:
+
+        handle_action_menu_selection()
+
+        update_display()
+
+        return
+
+    
+
+    # メイン画面
+
+    if current_screen == "main_menu":
+
+        menu_key = MAIN_MENU[selected_index][0]
+
+        if menu_key == "library":  # ライブラリ
+
+            current_screen = "library"
+
+            library_path = ""
+
+            library_items = get_library_items(library_path)
+
+            selected_index = 0
+
+        elif menu_key in TAG_VIEWS:  # アーティスト/アルバムアーティスト/ジャンル
+
+            current_screen = "library"
+
+            library_path = (menu_key,)
+
+            library_items = get_library_items(library_path)
+
+            selected_index = 0
+
+        elif menu_key == "search":  # 検索
+
+            current_screen = "search"
+
+            search_query = ""
+
+            search_mode = "input"
+
+            update_search_results()
+
+            ensure_search_index()
+
+            selected_index = 0
+
+        elif menu_key == "now_playing":  # 再生中
+
+            current_screen = "now_playing"
+            marquee_start = None  # スクロールをリセット
+            wake_now_playing()
+
+        elif menu_key == "queue":  # 再生キュー
+
+            current_screen = "queue"
+
+            queue_mirror.sync()
+
+            selected_index = 0
+
+        elif menu_key == "shutdown":  # シャットダウン
+
+            shutdown_system()
+
+            return
+
+        elif menu_key == "reboot":  # 再起動
+
+            reboot_system()
+
+            return
+
+        elif menu_key == "screen_off":  # 消灯
+
+            set_backlight(False)
+
+            return
+
+        elif menu_key == "wifi":  # WiFi
+
+            toggle_wifi()
+
+            update_display()
+
+            return
+
+    
+
+    # ライブラリ画面
+
+    elif current_screen == "library":
+
+        if selected_index < len(library_items):
+
+            item = library_items[selected_index]
+
+            
+
+            if item['type'] == 'message':
+
+                return
+
+            if item['type'] in ('directory', 'group'):
+
+                menu_stack.append((library_path, selected_index))
 
                 library_path = item['path']
 
-                library_items = get_library_items(library_path)
+                library_items = get_library_items(library_path)
+
+                selected_index = 0
+
+            else:
+
+                show_action_menu(item)
+
+    
+
+    # 検索画面
+
+    elif current_screen == "search":
+
+        if search_mode == "input":
+
+            # 選択中の文字を入力して結果を更新
+
+            search_query += SEARCH_ALPHABET[search_char_index]
+
+            update_search_results()
+
+            selected_index = 0
+
+        elif selected_index < len(search_results):
+
+            show_action_menu(search_results[selected_index])
+
+    
+
+    # キュー画面
+
+    elif current_screen == "queue":
+
+        if selected_index == 0:  # シャッフル
+
+            try:
+
+                status = mpd_client.status()
+
+                current = status.get('random', '0') == '1'
+
+                mpd_client.random(0 if current else 1)
+
+            except Exception as e:
+
+                print(f"Error toggling shuffle: {e}")
+
+        elif selected_index == 1:  # リピート
+
+            try:
+
+                status = mpd_client.status()
+
+                current = status.get('repeat', '0') == '1'
+
+                mpd_client.repeat(0 if current else 1)
+
+            except Exception as e:
+
+                print(f"Error toggling repeat: {e}")
+
+        else:
+
+            show_action_menu(queue_mirror[selected_index - 2])
+
+    
+
+    update_display()
+
+
+
+def handle_button_back(bt):
+
+    """戻るボタン処理"""
+
+    global current_screen, selected_index, library_path, library_items
+
+    global menu_stack, action_menu_visible, screen_off
+
+    global search_query, search_mode
+
+    
+
+    # 消灯中の場合は点灯のみ
+
+    if screen_off:
+
+        set_backlight(True)
+
+        update_display()
+
+        return
+
+    
+
+    if action_menu_visible:
+
+        action_menu_visible = False
+
+    elif current_screen == "library":
+
+        if menu_stack:
+
+            library_path, selected_index = menu_stack.pop()
+
+            library_items = get_library_items(library_path)
+
+        else:
+
+            current_screen = "main_menu"
+
+            selected_index = 0
+
+    elif current_screen == "search":
+
+        if search_mode == "results":
+
+            # 結果の選択から文字入力に戻る
+
+            search_mode = "input"
+
+        elif search_query:
+
+            # 1文字削除
+
+            search_query = search_query[:-1]
+
+            update_search_results()
+
+        else:
+
+            current_screen = "main_menu"
+
+            selected_index = 0
+
+    elif current_screen in ["now_playing", "queue"]:
+
+        current_screen = "main_menu"
+
+        selected_index = 0
+    update_display()
+
+
+
+def handle_button_up(bt):
+
+    """上ボタン処理"""
+
+    global selected_index, action_menu_index, screen_off
+
+    global search_char_index
+    # 消灯中の場合は点灯のみ
+
+    if screen_off:
+
+        set_backlight(True)
+
+        update_display()
+
+        return
+
+    
+
+    if current_screen == "now_playing":
+
+        # 音量アップ
+
+        try:
+
+            status = mpd_client.status()
+
+            current_vol = int(status.get('volume', 50))
+
+            new_vol = min(100, current_vol + 5)
+
+            mpd_client.setvol(new_vol)
+
+        except Exception as e:
+
+            print(f"Error changing volume: {e}")
+
+    elif action_menu_visible:
+
+        action_menu_index = max(0, action_menu_index - 1)
+
+        update_display()
+    elif current_screen == "search" and search_mode == "input":
+
+        # 入力する文字を前へ
+
+        search_char_index = (search_char_index - 1) % len(SEARCH_ALPHABET)
+
+        update_display()
+    else:
+
+        selected_index = max(0, selected_index - 1)
+
+        update_display()
+    
+
+    #update_display()
+
+
+
+def handle_button_down(bt):
+
+    """下ボタン処理"""
+
+    global selected_index, action_menu_index, screen_off
+
+    global search_char_index, search_mode
+    # 消灯中の場合は点灯のみ
+
+    if screen_off:
+
+        set_backlight(True)
+
+        update_display()
+
+        return
+
+    
+
+    if current_screen == "now_playing":
+
+        # 音量ダウン
+
+        try:
+
+            status = mpd_client.status()
+
+            current_vol = int(status.get('volume', 50))
+
+            new_vol = max(0, current_vol - 5)
+
+            mpd_client.setvol(new_vol)
+
+        except Exception as e:
+
+            print(f"Error changing volume: {e}")
+
+    elif action_menu_visible:
+
+        action_menu_index = min(len(action_menu_items) - 1, action_menu_index + 1)
+
+        update_display()
+    elif current_screen == "search" and search_mode == "input":
+
+        # 入力する文字を次へ。最後の文字の次は結果の選択に移る(結果があれば)
+
+        if search_char_index == len(SEARCH_ALPHABET) - 1 and search_results:
+
+            search_mode = "results"
+
+            selected_index = 0
+
+        else:
+
+            search_char_index = (search_char_index + 1) % len(SEARCH_ALPHABET)
+
+        update_display()
+    else:
+
+        max_index = 0
+
+        if current_screen == "main_menu":
+
+            max_index = len(MAIN_MENU) - 1
+
+        elif current_screen == "library":
+
+            max_index = len(library_items) - 1
+
+        elif current_screen == "queue":
+
+            max_index = len(queue_mirror) + 1
+
+        elif current_screen == "search":
+
+            max_index = len(search_results) - 1
+        selected_index = min(max_index, selected_index + 1)
+
+        update_display()
+    
+
+   # update_display()
+
+
+
+def search_alphabet_row():
+
+    """選択中の文字がある行の番号"""
+
+    return max(i for i, start in enumerate(SEARCH_ROW_STARTS) if start <= search_char_index)
+
+
+
+def handle_button_up_held(bt):
+
+    """上ボタン長押し処理(ライブラリでは前の頭文字へ、検索の文字入力では前の行へジャンプ)"""
+
+    global selected_index, search_char_index
+
+    if current_screen == "search" and search_mode == "input" and not screen_off:
+
+        search_char_index = SEARCH_ROW_STARTS[search_alphabet_row() - 1]
+
+        update_display()
+
+        return
+
+    if screen_off or action_menu_visible or current_screen != "library" or not library_items:
+
+        return
+
+    selected_index = library_items.previous_group(min(selected_index, len(library_items) - 1))
+
+    update_display()
+
+
+
+def handle_button_down_held(bt):
+
+    """下ボタン長押し処理(ライブラリでは次の頭文字へ、検索の文字入力では次の行へジャンプ)"""
+
+    global selected_index, search_char_index
+
+    if current_screen == "search" and search_mode == "input" and not screen_off:
+
+        search_char_index = SEARCH_ROW_STARTS[(search_alphabet_row() + 1) % len(SEARCH_ROW_STARTS)]
+
+        update_display()
+
+        return
+
+    if screen_off or action_menu_visible or current_screen != "library" or not library_items:
+
+        return
+
+    selected_index = library_items.next_group(min(selected_index, len(library_items) - 1))
+
+    update_display()
+
+
+
+def format_time(seconds):
+
+    """秒を MM:SS 形式に変換"""
+
+    minutes = int(seconds // 60)
+
+    secs = int(seconds % 60)
+
+    return f"{minutes:02d}:{secs:02d}"
+
+
+
+# アートワーク元画像の上限。これより大きいデータは転送もデコードもしない
+ART_MAX_SOURCE_BYTES = 8 * 1024 * 1024
+
+# デコードする画素数の上限(JPEGは縮小デコード後の大きさで判定)
+ART_MAX_SOURCE_PIXELS = 3000 * 3000
+
+# albumart/readpictureの1チャンクの大きさ(MPDの既定は8KBで往復が多い)
+ART_CHUNK_BYTES = 256 * 1024
+
+
+
+def read_binary_response(client, command, uri, max_bytes):
+
+    """albumart/readpictureをチャンクごとに読み、最初に確保したバッファへ詰める
+
+    python-mpd2の実装はチャンクをbytesの連結でつなぐため、大きな画像ではコピーが
+    チャンク数の2乗で増える。ここでは宣言されたサイズが上限を超えたら、残りの
+    チャンクを要求せずにNoneを返す。
+    """
+
+    try:
+
+        client.binarylimit(ART_CHUNK_BYTES)
+
+    except CommandError:
+
+        pass  # 0.22.4より前のMPD
+
+    buffer = None
+
+    offset = 0
+
+    while True:
+
+        client._write_command(command, [uri, offset])
+
+        response = client._read_binary()
+
+        chunk = response.get('binary')
+
+        if not chunk:
+
+            break
+
+        if buffer is None:
+
+            size = int(response.get('size', len(chunk)))
+
+            if size > max_bytes:
+
+                print(f"Album art too large ({size} bytes): {uri}")
+
+                return None
+
+            buffer = bytearray(size)
+
+        if offset + len(chunk) > len(buffer):
+
+            raise CommandError("Binary data announced size exceeded")
+
+        buffer[offset:offset + len(chunk)] = chunk
+
+        offset += len(chunk)
+
+        if offset == len(buffer):
+
+            break
+
+    if buffer is None or offset < len(buffer):
+
+        return None
+
+    return buffer
+
+
+
+def get_album_art(file_path):
+
+    """アルバムアートの画像データを取得(埋め込み画像→MPDのフォルダ画像→ローカルのフォルダ画像)
+
+    アートがなければNoneを返す。MPDとの通信エラーは呼び出し元に送る。
+    """
+
+    with mpd_client.connection(timeout=MPD_COMMAND_TIMEOUTS['albumart'], name='albumart') as client:
+
+        for command in ('readpicture', 'albumart'):
+
+            try:
+
+                data = read_binary_response(client, command, file_path, ART_MAX_SOURCE_BYTES)
+
+            except CommandError:
+
+                data = None  # 画像がない(readpictureに未対応のMPDも含む)
+
+            if data is not None:
+
+                return data
+
+    return get_folder_art(file_path)
+
+
+
+# フォルダ画像として探すファイル名(大文字小文字は区別しない)
+ART_FOLDER_NAMES = ("cover", "folder", "front", "album", "albumart")
+
+ART_FOLDER_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+# 曲のディレクトリ -> フォルダ画像のパス(なければNone)。データベース更新で破棄
+folder_art_index = {}
+
+folder_art_lock = threading.Lock()
+
+
+
+def find_folder_art(file_path):
+
+    """曲と同じディレクトリにあるフォルダ画像(folder.jpgなど)をMUSIC_DIRECTORYから探す"""
+
+    song_dir = os.path.dirname(file_path)
+
+    with folder_art_lock:
+
+        if song_dir in folder_art_index:
+
+            return folder_art_index[song_dir]
+
+    art_path = None
+
+    try:
+
+        names = {name.lower(): name for name in os.listdir(os.path.join(MUSIC_DIRECTORY, song_dir))}
+
+    except OSError:
+
+        names = {}
+
+    for base in ART_FOLDER_NAMES:
+
+        for extension in ART_FOLDER_EXTENSIONS:
+
+            if base + extension in names:
+
+                art_path = os.path.join(MUSIC_DIRECTORY, song_dir, names[base + extension])
+
+                break
+
+        if art_path:
+
+            break
+
+    with folder_art_lock:
+
+        folder_art_index[song_dir] = art_path
+
+    return art_path
+
+
+
+def get_folder_art(file_path):
+
+    """ローカルのフォルダ画像を読む(見つからないか大きすぎればNone)"""
+
+    art_path = find_folder_art(file_path)
+
+    if art_path is None:
+
+        return None
+
+    try:
+
+        if os.path.getsize(art_path) > ART_MAX_SOURCE_BYTES:
+
+            print(f"Album art too large: {art_path}")
+
+            return None
+
+        with open(art_path, 'rb') as f:
+
+            return f.read()
+
+    except OSError as e:
+
+        print(f"Error reading {art_path}: {e}")
+
+    return None
+
+
+
+def decode_album_art(data):
+
+    """画像データを画面サイズのRGB画像にデコード(JPEGは縮小デコードで読む)"""
+
+    with Image.open(BytesIO(data)) as image:
+
+        # JPEGはDCTの段階で1/2〜1/8に縮小してデコードされる(他の形式では何もしない)
+
+        image.draft('RGB', ART_SIZE)
+
+        if image.width * image.height > ART_MAX_SOURCE_PIXELS:
+
+            print(f"Album art too large ({image.width}x{image.height})")
+
+            return None
+
+        if image.mode != 'RGB':
+
+            image = image.convert('RGB')
+
+        # PNGなどは整数分の1に間引いてから仕上げの縮小をする
+
+        return image.resize(ART_SIZE, reducing_gap=2.0)
+
+
+
+# アルバムアートの表示サイズ(パネル全体)
+ART_SIZE = (240, 240)
+
+# 縮小済みアルバムアートのキャッシュの上限(バイト)。240x240のRGB565で1枚約113KB
+ART_CACHE_BYTES = 4 * 1024 * 1024
+
+# 縮小済みアルバムアートをパネルと同じRGB565(ビッグエンディアン)で保存する場所
+ART_DISK_CACHE_DIR = os.path.join(directory, ".pmpdp", "art")
+
+# ディスクキャッシュの上限(バイト)。1枚約113KBで約2300枚。超えたら使われていない順に上限の9割まで消す
+# (--art-cache-mb で変更できる。事前生成するならアルバム数に合わせて増やす)
+ART_DISK_CACHE_BYTES = 256 * 1024 * 1024
+
+# アルバムの識別キー -> 画面サイズに縮小済みのRGB565の画素(再生中画面の下地にそのまま使う)
+art_pixels_cache = LRUCache(ART_CACHE_BYTES, lambda pixels: pixels.nbytes)
+
+# アートが見つからなかったアルバムのキー(再描画のたびにMPDへ問い合わせない)。データベース更新で破棄
+art_missing = set()
+
+# 取得に失敗したアルバムのキー(エラーのログを1回だけ出すため)。データベース更新で破棄
+art_errors = set()
+
+# ディスクキャッシュの使用量(バイト)の見積もり。最初の書き込みで数える
+art_disk_usage = None
+
+art_disk_lock = threading.Lock()
+
+
+
+def invalidate_album_art(changed):
+
+    """データベース更新でアートなしの記録、フォルダ画像の索引、メモリ上のアートを破棄
+    (ディスクキャッシュは次に読むときに曲の更新時刻と比べて確かめる)"""
+
+    art_missing.clear()
+
+    art_errors.clear()
+
+    art_pixels_cache.clear()
+
+    with folder_art_lock:
+
+        folder_art_index.clear()
+
+
+
+def album_art_key(file_path, album, albumartist):
+
+    """アルバムアートのキャッシュキー(アルバムアーティスト+アルバム、なければディレクトリ)"""
+
+    if album:
+
+        return ('album', albumartist, album)
+
+    return ('dir', os.path.dirname(file_path))
+
+
+
+def rgb565_pixels(frame):
+
+    """RGB画像をRGB565(ビッグエンディアン)の2次元配列に変換"""
+
+    pixels = np.asarray(frame, dtype=np.uint16)
+
+    color = ((pixels[..., 0] & 0xF8) << 8) | ((pixels[..., 1] & 0xFC) << 3) | (pixels[..., 2] >> 3)
+
+    return color.astype('>u2')
+
+
+
+def art_disk_path(key):
+
+    """アルバムアートのディスクキャッシュのファイル名"""
+
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    return os.path.join(ART_DISK_CACHE_DIR, digest[:2], digest + ".rgb565")
+
+
+
+def load_art_pixels_from_disk(key, source_mtime=None):
+
+    """ディスクキャッシュからアルバムアートをRGB565の配列で読む(mmapするだけでデコードも色変換もしない)
+
+    source_mtime(曲の更新時刻)より古いキャッシュは、曲が書き換えられたものとして使わない。
+    """
+
+    path = art_disk_path(key)
+
+    try:
+
+        stat = os.stat(path)
+
+        if stat.st_size != ART_SIZE[0] * ART_SIZE[1] * 2:
+
+            return None
+
+        if source_mtime is not None and stat.st_mtime < source_mtime:
+
+            return None
+
+        pixels = np.memmap(path, dtype='>u2', mode='r', shape=(ART_SIZE[1], ART_SIZE[0]))
+
+        # 使われた順に残すため、アクセス時刻に使用時刻を記録する(更新時刻は作成時刻のまま)
 
-                selected_index = 0
+        os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
 
-            else:
+        return pixels
 
-                show_action_menu(item)
+    except FileNotFoundError:
 
-    
+        return None
 
-    # キュー画面
+    except Exception as e:
 
-    elif current_screen == "queue":
+        print(f"Error reading art cache {path}: {e}")
 
-        if selected_index == 0:  # シャッフル
+        return None
 
-            try:
 
-                status = mpd_client.status()
 
-                current = status.get('random', '0') == '1'
+def save_art_to_disk(key, pixels, prune=True):
 
-                mpd_client.random(0 if current else 1)
+    """縮小済みのアルバムアート(RGB565の画素)をディスクキャッシュに書く(途中で止まっても壊れないよう置き換えで書く)
 
-            except Exception as e:
+    pruneがTrueなら、上限を超えたときに使われていないものを消す(書いたものは消さない)。
+    """
 
-                print(f"Error toggling shuffle: {e}")
+    path = art_disk_path(key)
+
+    try:
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+
+        with open(tmp_path, "wb") as f:
+
+            f.write(pixels.tobytes())
+
+        os.replace(tmp_path, path)
+
+    except Exception as e:
+
+        print(f"Error writing art cache {path}: {e}")
+
+        return
+
+    if prune:
+
+        prune_art_disk_cache(ART_SIZE[0] * ART_SIZE[1] * 2, path)
 
-        elif selected_index == 1:  # リピート
+
+
+def art_disk_entries():
+
+    """ディスクキャッシュのファイル [(最終使用時刻, サイズ, パス)]"""
+
+    entries = []
+
+    for root, _, names in os.walk(ART_DISK_CACHE_DIR):
+
+        for name in names:
+
+            path = os.path.join(root, name)
 
             try:
 
-                status = mpd_client.status()
+                stat = os.stat(path)
 
-                current = status.get('repeat', '0') == '1'
+            except OSError:
 
-                mpd_client.repeat(0 if current else 1)
+                continue
 
-            except Exception as e:
+            entries.append((stat.st_atime, stat.st_size, path))
 
-                print(f"Error toggling repeat: {e}")
+    return entries
+
+
+
+def prune_art_disk_cache(added, keep):
+
+    """ディスクキャッシュが上限を超えたら、使われていない順に上限の9割まで消す(keepのファイルは残す)"""
+
+    global art_disk_usage
+
+    with art_disk_lock:
+
+        if art_disk_usage is None:
+
+            art_disk_usage = sum(size for _, size, _ in art_disk_entries())
 
         else:
 
-            show_action_menu(queue_items[selected_index - 2])
+            art_disk_usage += added
 
-    
+        if art_disk_usage <= ART_DISK_CACHE_BYTES:
 
-    update_display()
+            return
 
+        entries = sorted(art_disk_entries())
 
+        art_disk_usage = sum(size for _, size, _ in entries)
 
-def handle_button_back(bt):
+        for _, size, path in entries:
 
-    """戻るボタン処理"""
+            if art_disk_usage <= ART_DISK_CACHE_BYTES * 9 // 10:
 
-    global current_screen, selected_index, library_path, library_items
+                break
 
-    global menu_stack, action_menu_visible, screen_off
+            if path == keep:
 
-    
+                continue
 
-    # 消灯中の場合は無視
+            try:
 
-    if screen_off:
+                os.remove(path)
 
-        return
+            except FileNotFoundError:
 
-    
+                pass
 
-    if action_menu_visible:
+            except OSError as e:
 
-        action_menu_visible = False
+                print(f"Error removing art cache {path}: {e}")
 
-    elif current_screen == "library":
+                continue
 
-        if menu_stack:
+            art_disk_usage -= size
 
-            library_path, selected_index = menu_stack.pop()
 
-            library_items = get_library_items(library_path)
 
-        else:
+def render_album_frame(file_path):
 
-            current_screen = "main_menu"
+    """MPDからアルバムアートを取得して画面サイズのRGB画像にする"""
 
-            selected_index = 0
+    data = get_album_art(file_path)
 
-    elif current_screen in ["now_playing", "queue"]:
+    if data is None:
 
-        current_screen = "main_menu"
+        return None
 
-        selected_index = 0
+    try:
 
-    
+        return decode_album_art(data)
 
-    update_display()
+    except Exception as e:
 
+        print(f"Error decoding album art: {e}")
 
+    return None
 
-def handle_button_up(bt):
 
-    """上ボタン処理"""
 
-    global selected_index, action_menu_index, screen_off
+def load_album_pixels(file_path, key, source_mtime=None):
 
-    
+    """アルバムアートをメモリ→ディスク→MPDの順に探し、画面サイズのRGB565で返す(なければNone)
+
+    ディスクの内容はmmapしたまま使うので、取得・デコード・色変換はアルバムごとに1回だけ。
+    """
+
+    pixels = art_pixels_cache.get(key)
+
+    if pixels is None:
+
+        if key in art_missing:
+
+            return None
+
+        pixels = load_art_pixels_from_disk(key, source_mtime)
+
+        if pixels is None:
+
+            try:
 
-    # 消灯中の場合は無視
+                frame = render_album_frame(file_path)
+
+            except (MPDError, OSError) as e:
+
+                # 通信エラーや応答の異常は一時的なものとして、アートなしとは記録せず次の描画で再試行する
+
+                # (描画のたびに同じエラーを出さないよう、ログはアルバムごとに1回だけ)
+
+                if key not in art_errors:
+
+                    art_errors.add(key)
+
+                    print(f"Error loading album art for {file_path}: {e}")
+
+                return None
+
+            art_errors.discard(key)
+
+            if frame is None:
+
+                art_missing.add(key)
+
+                return None
+
+            pixels = rgb565_pixels(frame)
+
+            save_art_to_disk(key, pixels)
+
+        art_pixels_cache.put(key, pixels)
+
+    return pixels
+
+
+
+# 次の曲のアルバムアートを先読みするワーカー(再生中画面の描画を待たせない)
+art_prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="art-prefetch",
+                                           initializer=lower_thread_priority)
+
+
+
+def prefetch_next_song(changed):
+
+    """曲が変わる前に、次の曲のアルバムアートを取得して下地まで変換しておく"""
 
     if screen_off:
 
+        return  # 消灯中は何もしない(点灯後の変化で取得する)
+
+    art_prefetch_executor.submit(prefetch_next_song_job)
+
+
+
+def prefetch_next_song_job():
+
+    """次の曲のアルバムアートと変換済みの下地をキャッシュに入れる(ワーカー上で実行)
+
+    曲が変わったときの再描画は、どちらもキャッシュから取るだけになる。
+    """
+
+    status = get_current_status(include_next=True)
+
+    if status is None or status.next_song is None or status.state == 'stop':
+
         return
 
-    
+    song = status.next_song
 
-    if current_screen == "now_playing":
+    key = album_art_key(song['file'], tag_text(song, 'album'), tag_text(song, 'albumartist'))
 
-        # 音量アップ
+    load_album_pixels(song['file'], key, parse_mtime(song.get('last-modified')))
+
+
+
+def precompute_album_art(workers):
+
+    """MPDのデータベース全体を走査してアルバムアートのディスクキャッシュを作る(中断しても再開できる)"""
+
+    mpd_client.size = workers
+
+    # アルバムごとに代表の曲を1つ選び、いちばん新しい曲の更新時刻を覚える(結果は逐次読んでメモリに載せきらない)
+
+    albums = {}
+
+    with mpd_client.connection(timeout=MPD_COMMAND_TIMEOUTS['listallinfo'], name='listallinfo') as client:
+
+        client.iterate = True
 
         try:
 
-            status = mpd_client.status()
+            for song in client.listallinfo():
+
+                if 'file' in song:
+
+                    key = album_art_key(song['file'], tag_text(song, 'album'), tag_text(song, 'albumartist'))
+
+                    file_path, mtime = albums.get(key, (song['file'], 0))
+
+                    albums[key] = (file_path, max(mtime, parse_mtime(song.get('last-modified')) or 0))
+
+        finally:
+
+            client.iterate = False
+
+    def cached(key, mtime):
+
+        try:
+
+            return os.stat(art_disk_path(key)).st_mtime >= mtime
+
+        except OSError:
+
+            return False
+
+    todo = [(key, file_path) for key, (file_path, mtime) in albums.items() if not cached(key, mtime)]
+
+    print(f"Album art: {len(albums)} albums, {len(albums) - len(todo)} cached, {len(todo)} to generate")
+
+    # 上限を超えると再生時に消されて作り直しになるので、全アルバムが収まらなければ始めない
+
+    needed_mb = -(-len(albums) * ART_SIZE[0] * ART_SIZE[1] * 2 // (1024 * 1024))
+
+    if needed_mb > ART_DISK_CACHE_BYTES // (1024 * 1024):
+
+        print(f"Album art: needs up to {needed_mb}MB but the cache is limited to "
+
+              f"{ART_DISK_CACHE_BYTES // (1024 * 1024)}MB. Run with --art-cache-mb {needed_mb} "
+
+              f"(and start the player with the same option).")
+
+        return
+
+    def generate(key, file_path):
+
+        try:
+
+            frame = render_album_frame(file_path)
+
+        except (MPDError, OSError) as e:
+
+            print(f"Error loading album art for {file_path}: {e}")
+
+            return False
+
+        if frame is not None:
+
+            # 事前生成中は消さない(上限は開始前に確かめてある)
+
+            save_art_to_disk(key, rgb565_pixels(frame), prune=False)
+
+        return frame is not None
+
+    done = found = 0
+
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        for ok in executor.map(lambda job: generate(*job), todo):
+
+            done += 1
+
+            found += ok
+
+            if done % 50 == 0 or done == len(todo):
+
+                print(f"Album art: {done}/{len(todo)} ({found} with art, {time.monotonic() - start:.0f}s)")
+
+
+
+# 変化した行の間がこの行数以下なら1つの窓にまとめて送る(窓ごとのコマンド送信を減らす)
+PANEL_MERGE_GAP = 8
+
+# ST7789のスリープ開始(SLPIN)から解除までと、解除(SLPOUT)から次のコマンドまでの待ち時間(秒)
+PANEL_SLPIN_DELAY = 0.12
+
+PANEL_SLPOUT_DELAY = 0.005
+
+
+
+class PanelWriter:
+    """パネルに送った内容を覚えておき、前回から変化した矩形だけを送る
+
+    ST7789のアドレス窓(CASET/RASET)を変化した範囲に設定してから画素を送るので、
+    毎秒の情報部分の更新では240x240全体ではなく下端の帯だけが転送される。
+    座標は回転0で初期化したパネルのもの。
+    """
+
+    def __init__(self, panel):
+        self.panel = panel
+        self.front = None  # パネルに表示中の内容(RGB565)
+        self._lock = threading.Lock()
+        self.asleep = False
+        self._slept_at = 0.0
+        self.frames = 0
+        self.bytes_sent = 0
+
+    def sleep(self):
+        """表示を消してパネルをスリープさせる(メモリの内容は保持される)"""
+        with self._lock:
+            if self.asleep:
+                return
+            self.panel.command(st7789.ST7789_DISPOFF)
+            self.panel.command(st7789.ST7789_SLPIN)
+            self._slept_at = time.monotonic()
+            self.asleep = True
+
+    def wake(self):
+        """スリープを解除して、保持されている内容を表示する"""
+        with self._lock:
+            if not self.asleep:
+                return
+            # SLPINの後はSLPOUTまで、SLPOUTの後は次のコマンドまで待つ必要がある
+            time.sleep(max(0.0, self._slept_at + PANEL_SLPIN_DELAY - time.monotonic()))
+            self.panel.command(st7789.ST7789_SLPOUT)
+            time.sleep(PANEL_SLPOUT_DELAY)
+            self.panel.command(st7789.ST7789_DISPON)
+            self.asleep = False
+
+    def display(self, image, regions=None, base=None):
+        """画像をパネルに反映し、反映した内容(RGB565)を返す(変化がなければ何も送らない)
+
+        regions(PILの矩形のリスト)を渡すと、その範囲だけをRGB565に変換する。
+        範囲の外側は変換済みの下地baseと、baseがなければ表示中の内容と同じとみなす。
+        """
+        with self._lock:
+            if regions is None or (base is None and self.front is None):
+                frame = rgb565_pixels(image)
+            else:
+                frame = (base if base is not None else self.front).copy()
+                for x0, y0, x1, y1 in regions:
+                    frame[y0:y1, x0:x1] = rgb565_pixels(image.crop((x0, y0, x1, y1)))
+            self._show(frame)
+        return frame
+
+    def display_pixels(self, frame):
+        """変換済み(RGB565)の画面をそのまま反映する(frameは書き換えないこと)"""
+        with self._lock:
+            self._show(frame)
+
+    def _show(self, frame):
+        if self.front is None or self.front.shape != frame.shape:
+            windows = [(0, 0, frame.shape[1] - 1, frame.shape[0] - 1)]
+        else:
+            windows = self.changed_windows(self.front, frame)
+        for window in windows:
+            self._send(frame, window)
+        self.front = frame
+        self.frames += 1
+
+    @staticmethod
+    def changed_windows(old, new):
+        """変化した画素を囲む矩形のリスト [(x0, y0, x1, y1)](両端を含む)"""
+        diff = old != new
+        rows = np.flatnonzero(diff.any(axis=1))
+        if len(rows) == 0:
+            return []
+        # 近い行どうしをまとめ、まとめた行の範囲で変化した列の範囲を求める
+        breaks = np.flatnonzero(np.diff(rows) > PANEL_MERGE_GAP + 1)
+        windows = []
+        for run in np.split(rows, breaks + 1):
+            y0, y1 = int(run[0]), int(run[-1])
+            columns = np.flatnonzero(diff[y0:y1 + 1].any(axis=0))
+            windows.append((int(columns[0]), y0, int(columns[-1]), y1))
+        return windows
+
+    def _send(self, frame, window):
+        x0, y0, x1, y1 = window
+        data = frame[y0:y1 + 1, x0:x1 + 1].tobytes()
+        self.panel.set_window(x0, y0, x1, y1)
+        self.panel.data(data)
+        self.bytes_sent += len(data)
+
+
+
+# 再生中画面の情報部分(PILの矩形)。毎秒の更新ではここだけを変換・転送する
+NOW_PLAYING_INFO_BOX = (0, 208, 240, 240)
+
+# 再生中画面のタイトル行。スクロールのコマ送りではここだけを変換・転送する
+NOW_PLAYING_TITLE_BOX = (0, 224, 240, 240)
+
+# 描画要求の範囲(後ろほど広く、まとめるときは広い方を採る)
+RENDER_PARTS = ("title", "info", "full")
+
+# 変換済み(RGB565)の静的画面のキャッシュの上限(バイト)。240x240で1枚約113KB
+FRAME_CACHE_BYTES = 3 * 1024 * 1024
+
+# 画面の状態 -> 変換済みの画面(メインメニューなど、状態だけで内容が決まる画面)
+frame_cache = LRUCache(FRAME_CACHE_BYTES, lambda pixels: pixels.nbytes)
+
+def now_playing_base(status):
+
+    """再生中画面の下地(アルバムアートまたは黒)をRGB565で返す"""
+
+    pixels = None
+
+    if status and status.file:
+
+        pixels = load_album_pixels(status.file, album_art_key(status.file, status.album, status.albumartist),
+
+                                   status.last_modified)
+
+    if pixels is None:
+
+        pixels = art_pixels_cache.get(None)
+
+        if pixels is None:
+
+            pixels = np.zeros((ART_SIZE[1], ART_SIZE[0]), dtype='>u2')
+
+            art_pixels_cache.put(None, pixels)
+
+    return pixels
+
+
+
+class RenderPipeline:
+    """描画要求をまとめ、専用の表示スレッドが裏画面に描いてから表と入れ替えて送る
+
+    ボタンやMPDイベントのハンドラは状態を変えて request() するだけなので、
+    連打しても描画は最新の状態で1回にまとめられ、描きかけの画面が送られることもない。
+    描画関数が使うグローバルの img/draw は、描画中だけ裏画面を指す。
+    """
+
+    def __init__(self, size):
+        self.buffers = [Image.new("RGB", size, color=(0, 0, 0)) for _ in range(2)]
+        self.front = 0
+        self._cond = threading.Condition()
+        self._part = None  # 要求されている範囲(RENDER_PARTSのどれか)
+        self._status = None
+        self.requests = 0
+        self.renders = 0
+
+    def request(self, status=None, part="full"):
+        """再描画を要求する(partは"full"=画面全体、"info"=再生中画面の情報部分、"title"=タイトル行)"""
+        with self._cond:
+            if self._part is None or RENDER_PARTS.index(part) > RENDER_PARTS.index(self._part):
+                # 狭い範囲の要求と一緒に渡された状態(補間用の古いものかもしれない)は、
+                # 広い範囲の描画には使わない
+                self._part = part
+                self._status = status
+            elif part == self._part and status is not None:
+                self._status = status
+            self.requests += 1
+            self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            while self._part is None:
+                self._cond.wait()
+            request = (self._part, self._status)
+            self._part = None
+            self._status = None
+            return request
+
+    def run(self):
+        """表示スレッド本体"""
+        global img, draw
+
+        shown = None  # パネルに表示中の画面の状態
+        while True:
+            part, status = self._take()
+            if screen_off:
+                continue  # 消灯中は描かない(点灯時に描き直す)
+            full = part == "full"
+            if not full:
+                if current_screen != "now_playing" or status is None:
+                    continue
+                if shown != ("now_playing",):
+                    full = True  # 下地がまだ表示されていない
+
+            # 状態だけで内容が決まる画面は、変換済みのものがあれば描画も変換もしない
+            menu_items = None
+            cache_key = None
+            if full and current_screen == "main_menu" and not action_menu_visible:
+                menu_items = main_menu_items()
+                cache_key = ("main_menu", selected_index, tuple(menu_items))
+                pixels = frame_cache.get(cache_key)
+                if pixels is not None:
+                    panel.display_pixels(pixels)
+                    shown = cache_key
+                    continue
+
+            back = self.buffers[1 - self.front]
+            img = back
+            draw = ImageDraw.Draw(back)
+            regions = base = None
+            menu_state = None
+            if action_menu_visible:
+                menu_state = ("action_menu", current_screen, selected_index, tuple(action_menu_items))
+            try:
+                if not full:
+                    # 情報部分だけ描き替えるので、表示中の内容を引き継ぐ
+                    back.paste(self.buffers[self.front])
+                    if part == "title":
+                        draw_now_playing_title(status)
+                        regions = [NOW_PLAYING_TITLE_BOX]
+                    else:
+                        draw_now_playing_info(status)
+                        regions = [NOW_PLAYING_INFO_BOX]
+                elif menu_state is not None and menu_state == shown:
+                    # アクションメニュー内の移動はメニューの部分だけ描き替える
+                    back.paste(self.buffers[self.front])
+                    draw_action_menu()
+                    regions = [action_menu_box()]
+                else:
+                    if status is None and current_screen in ("now_playing", "queue"):
+                        status = get_current_status()
+                    render_display(status, menu_items)
+                    if current_screen == "now_playing":
+                        # 背景のアルバムアートは変換済みのものを使い、描いた部分だけを変換する
+                        regions = [NOW_PLAYING_INFO_BOX]
+                        if action_menu_visible:
+                            regions.append(action_menu_box())
+                        base = now_playing_base(status)
+            except Exception as e:
+                print(f"Error rendering display: {e}")
+                continue
+            pixels = panel.display(back, regions, base)
+            if cache_key is not None:
+                frame_cache.put(cache_key, pixels)
+            if menu_state is not None:
+                shown = menu_state
+            elif current_screen == "now_playing":
+                shown = ("now_playing",)
+            else:
+                shown = cache_key
+            self.front = 1 - self.front
+            self.renders += 1
+
+
+
+def update_display(status=None):
+
+    """ディスプレイの再描画を要求(statusは取得済みのスナップショットがあれば渡す)"""
+
+    # 画面が切り替わったら、その画面のジョブだけを動かす
+    scheduler.set_screen(current_screen)
+
+    render_pipeline.request(status)
+
+
+
+def update_now_playing_info(status):
+
+    """再生中画面の情報部分の再描画を要求"""
+
+    render_pipeline.request(status, "info")
+
+
+
+def update_now_playing_title(status):
+
+    """再生中画面のタイトル行(スクロールの1コマ)の再描画を要求"""
+
+    render_pipeline.request(status, "title")
+
+
+
+def render_display(status=None, menu_items=None):
+
+    """画面全体を裏画面に描画(表示スレッドから呼ばれる)"""
+
+    # 再生状態が必要な画面では1フレームにつき1回だけ取得して共有する
+    if status is None and current_screen in ("now_playing", "queue"):
+
+        status = get_current_status()
+
+    draw.rectangle((0, 0, disp.width, disp.height), (0, 0, 0))
 
-            current_vol = int(status.get('volume', 50))
+    
 
-            new_vol = min(100, current_vol + 5)
+    if current_screen == "main_menu":
 
-            mpd_client.setvol(new_vol)
+        draw_main_menu(menu_items)
 
-        except Exception as e:
+    elif current_screen == "library":
 
-            print(f"Error changing volume: {e}")
+        draw_library()
 
-    elif action_menu_visible:
+    elif current_screen == "now_playing":
 
-        action_menu_index = max(0, action_menu_index - 1)
+        # 背景のアルバムアートは裏画面には描かず、表示スレッドが変換済みの下地を使う
 
-        update_display()
-    else:
+        draw_now_playing_info(status)
 
-        selected_index = max(0, selected_index - 1)
+    elif current_screen == "queue":
 
-        update_display()
-    
+        draw_queue(status)
 
-    #update_display()
+    elif current_screen == "search":
 
+        draw_search()
+    if action_menu_visible:
 
+        draw_action_menu()
 
-def handle_button_down(bt):
 
-    """下ボタン処理"""
 
-    global selected_index, action_menu_index, screen_off
+# 文字の描画方法。"atlas"は文字画像の表を組み合わせる(速い)、"freetype"はPILで毎回描く
+TEXT_ENGINE = "atlas"
 
-    
+# 起動時に文字画像の表へ入れておく文字(それ以外は初めて使われたときに追加する)
+GLYPH_PRELOAD_RANGES = (
+    (0x20, 0x7E),      # ASCII
+    (0x3000, 0x303F),  # 和文の記号
+    (0x3041, 0x3096),  # ひらがな
+    (0x30A1, 0x30FC),  # カタカナ
+    (0xFF01, 0xFF5E),  # 全角英数
+)
 
-    # 消灯中の場合は無視
 
-    if screen_off:
 
-        return
+class GlyphAtlas:
+    """美咲フォントの文字画像を横に詰めて並べた表(NumPy配列)による文字描画
 
-    
+    美咲ゴシックは8x8のビットマップフォントなので、文字ごとに一度だけFreeTypeで
+    描いて表に入れておけば、文字列は表の切り出しを並べるだけで組み立てられる。
+    文字列の幅も覚えておく。表示スレッドからのみ使う。
+    """
 
-    if current_screen == "now_playing":
+    def __init__(self, atlas_font):
+        self.font = atlas_font
+        ascent, descent = atlas_font.getmetrics()
+        self.height = ascent + descent
+        self.atlas = np.zeros((self.height, 4096), dtype=np.uint8)
+        self.used = 0
+        self.glyphs = {}  # 文字 -> (表の中のx, 文字画像の幅, 送り幅)
+        self.widths = LRUCache(64 * 1024, lambda width: 64)  # 文字列 -> 幅
+        for first, last in GLYPH_PRELOAD_RANGES:
+            for code in range(first, last + 1):
+                self.glyph(chr(code))
 
-        # 音量ダウン
+    def glyph(self, ch):
+        """1文字分の(表の中のx, 文字画像の幅, 送り幅)。なければ描いて表に追加する"""
+        entry = self.glyphs.get(ch)
+        if entry is None:
+            advance = int(round(self.font.getlength(ch)))
+            cell = max(advance, self.font.getbbox(ch)[2], 1)
+            image = Image.new("L", (cell, self.height), 0)
+            ImageDraw.Draw(image).text((0, 0), ch, font=self.font, fill=255)
+            if self.used + cell > self.atlas.shape[1]:
+                self.atlas = np.concatenate((self.atlas, np.zeros_like(self.atlas)), axis=1)
+            self.atlas[:, self.used:self.used + cell] = np.asarray(image)
+            entry = (self.used, cell, advance)
+            self.glyphs[ch] = entry
+            self.used += cell
+        return entry
 
-        try:
+    def width(self, text):
+        """文字列の送り幅の合計"""
+        width = self.widths.get(text)
+        if width is None:
+            width = sum(self.glyph(ch)[2] for ch in text)
+            self.widths.put(text, width)
+        return width
 
-            status = mpd_client.status()
+    def render(self, text):
+        """文字列の濃度マスク(高さ×幅のuint8配列)。空文字列ならNone"""
+        glyphs = [self.glyph(ch) for ch in text]
+        if not glyphs:
+            return None
+        width = max(sum(g[2] for g in glyphs[:-1]) + glyphs[-1][1], 1)
+        mask = np.zeros((self.height, width), dtype=np.uint8)
+        x = 0
+        for x0, cell, advance in glyphs:
+            target = mask[:, x:x + cell]
+            np.maximum(target, self.atlas[:, x0:x0 + cell], out=target)
+            x += advance
+        return mask
 
-            current_vol = int(status.get('volume', 50))
 
-            new_vol = max(0, current_vol - 5)
 
-            mpd_client.setvol(new_vol)
+# 美咲フォントの文字画像の表(TEXT_ENGINEが"atlas"のとき起動時に作る)
+glyph_atlas = None
 
-        except Exception as e:
 
-            print(f"Error changing volume: {e}")
 
-    elif action_menu_visible:
+def text_width(text, text_font=None):
 
-        action_menu_index = min(len(action_menu_items) - 1, action_menu_index + 1)
+    """文字列の表示幅"""
 
-        update_display()
-    else:
+    text_font = text_font or font_small
 
-        max_index = 0
+    if glyph_atlas is not None and text_font is glyph_atlas.font:
 
-        if current_screen == "main_menu":
+        return glyph_atlas.width(text)
 
-            max_index = 6  # 7項目(0-6)
+    bbox = draw.textbbox((0, 0), text, font=text_font)
 
-        elif current_screen == "library":
+    return bbox[2] - bbox[0]
 
-            max_index = len(library_items) - 1
 
-        elif current_screen == "queue":
 
-            max_index = len(queue_items) + 1
+def text_mask(text, text_font=None):
 
-        
+    """文字列の濃度マスク(高さ×幅のuint8配列)"""
 
-        selected_index = min(max_index, selected_index + 1)
+    text_font = text_font or font_small
 
-        update_display()
-    
+    if glyph_atlas is not None and text_font is glyph_atlas.font:
 
-   # update_display()
+        mask = glyph_atlas.render(text)
 
+        if mask is not None:
 
+            return mask
 
-def format_time(seconds):
+    ascent, descent = text_font.getmetrics()
 
-    """秒を MM:SS 形式に変換"""
+    image = Image.new("L", (max(int(text_font.getlength(text)), 1), ascent + descent), 0)
 
-    minutes = int(seconds // 60)
+    ImageDraw.Draw(image).text((0, 0), text, font=text_font, fill=255)
 
-    secs = int(seconds % 60)
+    return np.asarray(image)
 
-    return f"{minutes:02d}:{secs:02d}"
 
 
+def draw_text(xy, text, fill, text_font=None, image=None):
 
-def get_album_art(file_path):
+    """文字列を描く(文字画像の表が使えるフォントならFreeTypeを通さない)"""
 
-    """アルバムアートを取得(MPDの埋め込みアートワークを使用)"""
+    text_font = text_font or font_small
 
-    try:
+    image = img if image is None else image
 
-        # MPDから埋め込みアートワークを取得
+    if glyph_atlas is not None and text_font is glyph_atlas.font:
 
-        albumart = mpd_client.albumart(file_path)
+        mask = glyph_atlas.render(text)
 
-        if albumart and 'binary' in albumart:
+        if mask is not None:
 
-            from io import BytesIO
+            x, y = xy
 
-            art_data = albumart['binary']
+            image.paste(fill, (x, y, x + mask.shape[1], y + mask.shape[0]), Image.fromarray(mask, "L"))
 
-            return Image.open(BytesIO(art_data))
+        return
 
-    except Exception as e:
+    target = draw if image is img else ImageDraw.Draw(image)
 
-            print(f"Error loading cover.jpg: {e}")
+    target.text(xy, text, font=text_font, fill=fill, spacing=0)
 
-    return None
 
 
+# 描画済みの行のキャッシュの上限(バイト)。240x17のグレースケールで1行約4KB
+ROW_CACHE_BYTES = 1024 * 1024
 
-def update_display():
+# (文字列, 書式, 幅) -> 1行分の描画結果
+row_cache = LRUCache(ROW_CACHE_BYTES, lambda row: row.width * row.height)
 
-    """ディスプレイを更新"""
 
-    draw.rectangle((0, 0, disp.width, disp.height), (0, 0, 0))
 
-    
+def row_bitmap(text, style, width):
 
-    if current_screen == "main_menu":
+    """一覧の1行分の画像(反転表示なら白地に黒文字)。同じ行は描画し直さない
 
-        draw_main_menu()
+    styleは(反転するか, 行の高さ, 文字の上端, フォント)。
+    """
 
-    elif current_screen == "library":
+    key = (text, style, width)
 
-        draw_library()
+    row = row_cache.get(key)
 
-    elif current_screen == "now_playing":
+    if row is None:
 
-        draw_now_playing()
+        inverted, height, text_y, row_font = style
 
-    elif current_screen == "queue":
+        row = Image.new("L", (width, height), 255 if inverted else 0)
 
-        draw_queue()
+        draw_text((2, text_y), text, 0 if inverted else 255, row_font, row)
 
-    
+        row_cache.put(key, row)
 
-    if action_menu_visible:
+    return row
 
-        draw_action_menu()
 
-    
 
-    disp.display(img)
+def draw_row(y, text, inverted, height, text_y=0, row_font=None):
 
+    """一覧の1行を(0, y)から描く"""
 
+    img.paste(row_bitmap(text, (inverted, height, text_y, row_font or font_small), disp.width), (0, y))
 
-def draw_main_menu():
 
-    """メインメニューを描画"""
 
-    wifi_status = "ON" if get_wifi_status() else "OFF"
+def main_menu_items():
 
-    menu_items = [
+    """メインメニューの表示文字列(WiFiの状態を含む)"""
 
-        "ライブラリ", 
+    wifi_status = "ON" if get_wifi_status() else "OFF"
 
-        "再生中", 
+    return [f"{label} ({wifi_status})" if key == "wifi" else label for key, label in MAIN_MENU]
 
-        "再生キュー",
 
-        "シャットダウン",
 
-        "再起動",
+def draw_main_menu(menu_items=None):
 
-        "消灯",
+    """メインメニューを描画"""
 
-        f"WiFi ({wifi_status})"
+    if menu_items is None:
 
-    ]
+        menu_items = main_menu_items()
 
     line_height = 16  # 行間0px
 
@@ -1025,15 +4060,7 @@ def draw_main_menu():
 
         y = i * line_height
 
-        if i == selected_index:
-
-            draw.rectangle([0, y + 1, disp.width, y + line_height], fill=(255, 255, 255))
-
-            draw.text((2, y + 2), item, font=font, fill=(0, 0, 0), spacing=0)
-
-        else:
-
-            draw.text((2, y + 2), item, font=font, fill=(255, 255, 255), spacing=0)
+        draw_row(y + 1, item, i == selected_index, line_height, 1, font)
 
 
 
@@ -1041,6 +4068,8 @@ def draw_library():
 
     """ライブラリを描画"""
 
+    schedule_library_prefetch()
+
     line_height = 17  # 行間0px
 
     max_lines = 14
@@ -1059,122 +4088,139 @@ def draw_library():
 
         item = library_items[i]
 
-        prefix = ">" if item['type'] == 'directory' else ""
+        prefix = ">" if item['type'] in ('directory', 'group') else ""
 
         name = prefix + item['name']
 
         
 
-        if i == selected_index:
+        draw_row(y + 1, name[:40], i == selected_index, line_height, 1)
 
-            draw.rectangle([0, y + 1, disp.width, y + line_height], fill=(255, 255, 255))
 
-            draw.text((2, y + 2), name[:40], font=font_small, fill=(0, 0, 0), spacing=0)
 
-        else:
 
-            draw.text((2, y + 2), name[:40], font=font_small, fill=(255, 255, 255), spacing=0)
+def draw_now_playing_info(status):
 
+    """再生中画面の情報部分を描画(独立して更新)"""
 
+    if status:
 
-def draw_now_playing():
+        # (0, 208)から(240, 240)までの黒背景を描画
 
-    """再生中画面を描画"""
+        draw.rectangle((0, 208, disp.width, disp.height), fill=(0, 0, 0))
 
-    status = get_current_status()
+        
 
-    
+        # 再生時間
 
-    if status:
+        elapsed_str = format_time(interpolated_elapsed())
 
-        # アルバムアート(背景)
+        duration_str = format_time(status.duration)
 
-        art = get_album_art(status['file'])
+        time_text = f"{elapsed_str} / {duration_str}"
 
-        if art:
+        draw_text((2, 208), time_text, (255, 255, 255))
 
-            art = art.resize((disp.width, disp.height))
+        
 
-            img.paste(art, (0, 0))
+        # ステータス
 
+        state_text = "再生中" if status.state == 'play' else "停止中"
 
+        state_width = text_width(state_text)
 
+        draw_text((disp.width - state_width - 2, 208), state_text, (255, 255, 255))
 
-def draw_now_playing_info():
+        
 
-    """再生中画面の情報部分を描画(独立して更新)"""
+        # タイトル情報(スクロール対応)
 
-    global title_scroll_offset
+        draw_now_playing_title(status)
 
-    
 
-    status = get_current_status()
 
-    
+# タイトルのスクロールのコマ数(毎秒)と速さ(ピクセル毎秒)
+MARQUEE_FPS = 20
 
-    if status:
+MARQUEE_SPEED = 16
 
-        # (0, 208)から(240, 240)までの黒背景を描画
+# スクロールするタイトルの繰り返しの間隔(ピクセル)
+MARQUEE_GAP = 32
 
-        draw.rectangle((0, 208, disp.width, disp.height), fill=(0, 0, 0))
+# タイトル行の表示幅
+MARQUEE_WIDTH = NOW_PLAYING_TITLE_BOX[2] - NOW_PLAYING_TITLE_BOX[0] - 4
 
-        
+marquee_strip_cache = (None, None)  # (タイトル, 横長に描いたタイトルの濃度マスク)
 
-        # 再生時間
 
-        elapsed_str = format_time(status['elapsed'])
 
-        duration_str = format_time(status['duration'])
+def marquee_strip(title):
 
-        time_text = f"{elapsed_str} / {duration_str}"
+    """表示幅に収まらないタイトルを「タイトル+間隔+タイトル」の横長のマスクに一度だけ描く"""
 
-        draw.text((2, 208), time_text, font=font_small, fill=(255, 255, 255))
+    global marquee_strip_cache
 
-        
+    if marquee_strip_cache[0] != title:
 
-        # ステータス
+        mask = text_mask(title)
 
-        state_text = "再生中" if status['state'] == 'play' else "停止中"
+        strip = None
 
-        state_bbox = draw.textbbox((0, 0), state_text, font=font_small)
+        if mask.shape[1] > MARQUEE_WIDTH:
 
-        state_width = state_bbox[2] - state_bbox[0]
+            width = mask.shape[1]
 
-        draw.text((disp.width - state_width - 2, 208), 
+            strip = np.zeros((mask.shape[0], 2 * width + MARQUEE_GAP), dtype=np.uint8)
 
-                 state_text, font=font_small, fill=(255, 255, 255))
+            strip[:, :width] = mask
 
-        
+            strip[:, width + MARQUEE_GAP:] = mask
 
-        # タイトル情報(スクロール対応)
+        marquee_strip_cache = (title, strip)
 
-        title = status['title'] if status['title'] else "No Title"
+    return marquee_strip_cache[1]
 
-        
 
-        # タイトルが14文字を超える場合はスクロール
 
-        if len(title) > 14:
+def draw_now_playing_title(status):
 
-            # スクロール用の拡張テキスト(ループ用に2回繰り返し + スペース)
+    """再生中画面のタイトル行を描画(長いタイトルは横長の画像を切り出してピクセル単位でスクロール)"""
 
-            scroll_text = title + " " + title + " " + title + " " + title
+    global marquee_active
 
-            # オフセットを計算(1文字ずつ)
+    title = status.title if status.title else "No Title"
 
-            display_text = scroll_text[title_scroll_offset:title_scroll_offset + 28 ]
+    x0, y0, x1, y1 = NOW_PLAYING_TITLE_BOX
 
-        else:
+    draw.rectangle((x0, y0, x1 - 1, y1 - 1), fill=(0, 0, 0))
 
-            display_text = title
+    strip = marquee_strip(title)
 
-        
+    marquee_active = strip is not None and status.state == 'play'
 
-        draw.text((2, 224), display_text, font=font_small, fill=(255, 255, 255))
+    if strip is None:
 
+        draw_text((2, y0), title, (255, 255, 255))
 
+        return
+
+    offset = 0
+
+    start = marquee_start
+
+    if marquee_active and start is not None:
+
+        period = (strip.shape[1] + MARQUEE_GAP) // 2  # タイトルの幅+間隔
+
+        offset = int((time.monotonic() - start) * MARQUEE_SPEED) % period
+
+    window = np.ascontiguousarray(strip[:, offset:offset + MARQUEE_WIDTH])
+
+    img.paste((255, 255, 255), (2, y0, 2 + window.shape[1], y0 + window.shape[0]), Image.fromarray(window, "L"))
 
-def draw_queue():
+
+
+def draw_queue(status):
 
     """再生キューを描画"""
 
@@ -1182,19 +4228,19 @@ def draw_queue():
 
     max_lines = 14
 
-    status = get_current_status()
-
     
 
     # 特殊項目
 
-    shuffle_text = f"シャッフル再生 ({'ON' if status and status['random'] else 'OFF'})"
+    shuffle_text = f"シャッフル再生 ({'ON' if status and status.random else 'OFF'})"
 
-    repeat_text = f"リピート再生 ({'ON' if status and status['repeat'] else 'OFF'})"
+    repeat_text = f"リピート再生 ({'ON' if status and status.repeat else 'OFF'})"
 
     
 
-    all_items = [shuffle_text, repeat_text] + [item['name'] for item in queue_items]
+    special_items = [shuffle_text, repeat_text]
+
+    total = len(special_items) + len(queue_mirror)
 
     
 
@@ -1202,37 +4248,95 @@ def draw_queue():
 
     
 
-    for i in range(start_idx, min(len(all_items), start_idx + max_lines)):
+    for i in range(start_idx, min(total, start_idx + max_lines)):
 
         yi = i - start_idx
 
         y = yi * line_height
 
+        text = special_items[i] if i < len(special_items) else queue_mirror[i - len(special_items)]['name']
+
         
 
-        if i == selected_index:
+        draw_row(y, text[:40], i == selected_index, line_height)
 
-            draw.rectangle([0, y, disp.width, y + line_height], fill=(255, 255, 255))
 
-            draw.text((2, y), all_items[i][:40], font=font_small, fill=(0, 0, 0), spacing=0)
 
-        else:
+def draw_search():
 
-            draw.text((2, y), all_items[i][:40], font=font_small, fill=(255, 255, 255), spacing=0)
+    """検索画面を描画"""
 
+    line_height = 16  # 行間0px
 
+    max_lines = 13
 
-def draw_action_menu():
+    # 入力欄(選択中の文字を反転表示)
 
-    """アクションメニューを描画"""
+    prefix = "検索:" + search_query[-11:]
+
+    x = 2 + text_width(prefix)
+
+    draw_text((2, 0), prefix, (255, 255, 255))
+
+    if search_mode == "input":
+
+        draw.rectangle([x, 0, x + 16, line_height], fill=(255, 255, 255))
+
+        draw_text((x, 0), SEARCH_ALPHABET[search_char_index], (0, 0, 0))
+
+    # 件数またはメッセージ
+
+    if search_index is None:
+
+        message = "索引を作成中..." if library_index.ready else "ライブラリ索引がありません"
+
+    elif search_query.strip():
+
+        message = f"{len(search_results)}件" + ("以上" if len(search_results) >= SEARCH_MAX_RESULTS else "")
+
+    else:
+
+        message = ""
+
+    draw_text((2, line_height), message, (160, 160, 160))
+
+    draw.line([0, 2 * line_height, disp.width, 2 * line_height], fill=(100, 100, 100))
+
+    # 結果
+
+    start_idx = max(0, selected_index - max_lines // 2) if search_mode == "results" else 0
+
+    for i in range(start_idx, min(len(search_results), start_idx + max_lines)):
+
+        y = (i - start_idx + 2) * line_height + 1
+
+        name = search_results[i]['name'][:40]
+
+        draw_row(y, name, search_mode == "results" and i == selected_index, line_height, 1)
+
+
+
+def action_menu_box():
+
+    """アクションメニューの外枠(PILの矩形、右端・下端は含まない)"""
 
     menu_height = len(action_menu_items) * 35 + 20
 
     menu_y = (disp.height - menu_height) // 2
 
+    return (20, menu_y, disp.width - 19, menu_y + menu_height + 1)
+
+
+
+def draw_action_menu():
+
+    """アクションメニューを描画"""
+
+    x0, menu_y, x1, y1 = action_menu_box()
+
     
 
-    draw.rectangle([20, menu_y, disp.width - 20, menu_y + menu_height], 
+    draw.rectangle([x0, menu_y, x1 - 1, y1 - 1], 
 
                   fill=(50, 50, 50), outline=(255, 255, 255))
 
@@ -1258,6 +4362,16 @@ def init_buttons():
 
     """ボタンを初期化"""
 
+    global button_action, button_back, button_up, button_down
+
+    button_action = Button(5)
+
+    button_back = Button(6)
+
+    button_up = Button(16, hold_time=LONG_PRESS_SECONDS, hold_repeat=True)
+
+    button_down = Button(20, hold_time=LONG_PRESS_SECONDS, hold_repeat=True)
+
     button_action.when_pressed = handle_button_action
 
     button_back.when_pressed = handle_button_back
@@ -1266,91 +4380,224 @@ def init_buttons():
 
     button_down.when_pressed = handle_button_down
 
+    button_up.when_held = handle_button_up_held
+
+    button_down.when_held = handle_button_down_held
+
 def connect_mpd():
     """MPDに接続"""
     try:
-        mpd_client.connect("localhost", 6600)
+        # プールの最初の接続を張って疎通を確認
+        mpd_client.ping()
         print("MPD connected successfully")
         return True
     except Exception as e:
         print(f"MPD connection error: {e}")
         return False
 
-def keep_alive_loop():
+# 消灯中に届いて画面に反映していないMPDの変化
+missed_mpd_events = set()
 
-    """メインクライアントの接続状態を定期的に確認し、切断されていたら再接続する"""
+# 消灯中でも、このサブシステムが変化したら点灯する(例: ("player",) で曲の開始・停止時に点灯)
+SCREEN_WAKE_EVENTS = ()
 
-    global mpd_client
 
-    # 30秒ごとに接続を確認
 
-    interval = 5
+def catch_up_mpd_events():
+    """消灯中に届いたMPDの変化を画面に反映する"""
+    changed = set(missed_mpd_events)
+    missed_mpd_events.clear()
+    if changed & {"player", "playlist", "options"}:
+        # 消灯中の状態は古いので取り直し(再生位置の補間の基準も更新される)、次の曲も先読みし直す
+        get_current_status()
+        prefetch_next_song(changed)
+    if changed:
+        handle_mpd_event(changed)
 
-    
 
-    while True:
+def wake_screen_on_event(changed):
+    """SCREEN_WAKE_EVENTSの変化で消灯中の画面を点灯する"""
+    if screen_off:
+        set_backlight(True)
+        update_display()
+
 
+def subscribe_mpd_events(subsystems, handler):
+    """idleイベントの購読者を登録する(handlerには変化したサブシステムのsetが渡される)"""
+    mpd_event_handlers.append((frozenset(subsystems), handler))
+
+
+def dispatch_mpd_event(changed):
+    """変化したサブシステムを購読者に通知"""
+    changed = set(changed)
+    for subsystems, handler in list(mpd_event_handlers):
+        if subsystems & changed:
+            try:
+                handler(changed)
+            except Exception as e:
+                print(f"Error handling MPD event {sorted(changed)}: {e}")
+
+
+def mpd_idle_loop():
+    """専用接続でMPDのidleを待ち受け、変化をイベントとして通知する"""
+    retry_delay = 1
+    reconnecting = False
+
+    while True:
         try:
-            # mpd_client.ping() は、接続が正常ならTrueを返すか何も返さない
-            # 接続が切断されていれば例外(ConnectionError/ProtocolError)が発生する
-            mpd_client.ping()
-            # print("Main client ping successful.") # デバッグ用
+            idle_client.connect(MPD_HOST, MPD_PORT)
+            retry_delay = 1
+            if reconnecting:
+                # 切断中の変化を取りこぼさないよう全サブシステムを通知
+                dispatch_mpd_event(MPD_IDLE_SUBSYSTEMS)
+            while True:
+                # 変化があるまでブロックする(ポーリングしない)
+                changed = idle_client.idle(*MPD_IDLE_SUBSYSTEMS)
+                dispatch_mpd_event(changed)
         except Exception as e:
-            # 接続エラーやソケットエラーが発生した場合
-            print(f"Main client keep-alive failed: {e}. Attempting reconnect...")
+            print(f"MPD idle listener error: {e}. Reconnecting...")
             try:
-                # 既存の接続を確実に切断
-                mpd_client.disconnect()
+                idle_client.disconnect()
             except:
                 pass
-            try:
-                # 再接続
-                mpd_client.connect("localhost", 6600)
-            except Exception as re_e:
-                print(f"Main client reconnection failed: {re_e}.")
-        time.sleep(interval)
+            reconnecting = True
+            time.sleep(retry_delay)
+            retry_delay = min(30, retry_delay * 2)
 
 
-def now_playing_update_loop():
-    """再生中画面の情報部分を毎秒更新"""
-    global title_scroll_offset
-    
-    while True:
-        if current_screen == "now_playing" and not screen_off:
-            status = get_current_status()
-            if status:
-                title = status['title'] if status['title'] else "No Title"
-                
-                # 再生中の場合のみタイトルスクロール
-                if status['state'] == 'play' and len(title) > 14:
-                    title_scroll_offset += 1
-                    # ループ処理(タイトル長 + スペース2文字分でリセット)
-                    if title_scroll_offset >= len(title) + 2:
-                        title_scroll_offset = 0
-                else:
-                    # 停止中またはタイトルが短い場合はリセット
-                    title_scroll_offset = 0
-                
-                # 情報部分のみ再描画
-                draw_now_playing_info()
-                disp.display(img)
-        else:
-            # 再生中画面以外ではスクロールをリセット
-            title_scroll_offset = 0
-        
-        time.sleep(1)
+def handle_mpd_event(changed):
+    """MPDの変化に応じて画面を更新"""
+    global current_song_id, selected_index
+
+    if screen_off:
+        # 消灯中は画面を更新せず、点灯時にまとめて反映する
+        missed_mpd_events.update(changed)
+        return
+
+    if current_screen == "now_playing" and "player" in changed:
+        status = get_current_status()
+        if status is None:
+            return
+        # 曲が変更された場合は画面全体、それ以外は情報部分のみ更新
+        if status.songid != current_song_id:
+            current_song_id = status.songid
+            update_display(status)
+        wake_now_playing()
+
+    elif current_screen == "queue" and not action_menu_visible and not moving_queue_item:
+        status = get_current_status()
+        if "playlist" in changed:
+            queue_mirror.sync(status)
+            selected_index = min(selected_index, len(queue_mirror) + 1)
+        if changed & {"playlist", "options"}:
+            update_display(status)
+
+
+def wake_now_playing():
+    """再生中画面の情報部分をすぐに描き直す(再生状態の変化や画面の切り替え時)"""
+    global now_playing_woken
+
+    now_playing_woken = True
+    scheduler.run_soon(now_playing_job)
+
+
+def now_playing_tick():
+    """再生中画面の情報部分を秒が変わるごとに更新する(スケジューラのジョブ)
+    再生位置は補間し、MPDへの問い合わせはずれ補正のジョブに任せる。"""
+    global marquee_start, now_playing_woken, now_playing_second, now_playing_title
+
+    if screen_off:
+        return Scheduler.STOP  # 点灯時に再開する
+
+    status = playback_clock[0]
+    if status is None:
+        status = get_current_status()
+        if status is None:
+            return 1
+
+    title = status.title if status.title else "No Title"
+
+    # 再生中のみスクロールし、曲が変わるか停止したら先頭に戻す
+    if status.state != 'play' or title != now_playing_title:
+        marquee_start = None
+    if status.state == 'play' and marquee_start is None:
+        marquee_start = time.monotonic()
+    now_playing_title = title
+
+    second = int(interpolated_elapsed())
+    if now_playing_woken or second != now_playing_second:
+        now_playing_woken = False
+        now_playing_second = second
+        update_now_playing_info(status)
+
+    if status.state != 'play':
+        return Scheduler.STOP  # 停止中は表示が変わらない(変化はイベントで起こされる)
+
+    if marquee_active:
+        scheduler.run_soon(marquee_job, 1 / MARQUEE_FPS)
+
+    # 表示する秒が切り替わる瞬間に次の更新をする
+    return max(0.01, 1 - interpolated_elapsed() % 1)
+
+
+def marquee_frame():
+    """長いタイトルのスクロールを1コマ進める(スケジューラのジョブ)"""
+    status = playback_clock[0]
+    if screen_off or not marquee_active or status is None or status.state != 'play':
+        return Scheduler.STOP
+    update_now_playing_title(status)
+
+
+def drift_check():
+    """再生中は補間した再生位置をMPDの値で補正する(スケジューラのジョブ)"""
+    status, synced_at = playback_clock
+    if screen_off or status is None or status.state != 'play':
+        return
+    # イベントで最近取得していれば、その時刻から数えて補正する
+    age = time.monotonic() - synced_at
+    if age < DRIFT_CHECK_INTERVAL:
+        return DRIFT_CHECK_INTERVAL - age
+    get_current_status()
+
+
+# 再生中画面のジョブ(別の画面の表示中は保留される)
+now_playing_job = scheduler.add("now-playing", now_playing_tick, priority=0, screen="now_playing")
+
+marquee_job = scheduler.add("marquee", marquee_frame, interval=1 / MARQUEE_FPS, priority=1,
+                            screen="now_playing")
+
+drift_check_job = scheduler.add("drift-check", drift_check, interval=DRIFT_CHECK_INTERVAL, priority=2,
+                                screen="now_playing", delay=DRIFT_CHECK_INTERVAL)
 
 
 # メイン処理
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Portable MPD Player")
+    parser.add_argument("--precompute-art", action="store_true",
+                        help="アルバムアートのディスクキャッシュを事前に作成して終了する")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="--precompute-art の同時処理数")
+    parser.add_argument("--art-cache-mb", type=int, default=ART_DISK_CACHE_BYTES // (1024 * 1024),
+                        help="アルバムアートのディスクキャッシュの上限(MB)")
+    args = parser.parse_args()
+    ART_DISK_CACHE_BYTES = args.art_cache_mb * 1024 * 1024
+
     # MPD接続
 
     if not connect_mpd():
         print("Failed to connect to MPD. Exiting.")
         sys.exit(1)
 
+    if args.precompute_art:
+        try:
+            precompute_album_art(args.workers)
+        except KeyboardInterrupt:
+            print("\nInterrupted. Run again to resume.")
+        mpd_client.close_all()
+        sys.exit(0)
+
     
 
     # ディスプレイ初期化
@@ -1381,11 +4628,17 @@ if __name__ == "__main__":
 
     disp.begin()
 
+    # 変化した部分だけをパネルに送る
+    panel = PanelWriter(disp)
+
     WIDTH = disp.width
 
     HEIGHT = disp.height
 
-    img = Image.new("RGB", (WIDTH, HEIGHT), color=(0, 0, 0))
+    # 描画は表示スレッドが裏画面に行い、描き終えてから表と入れ替えて送る
+    render_pipeline = RenderPipeline((WIDTH, HEIGHT))
+
+    img = render_pipeline.buffers[0]
 
     draw = ImageDraw.Draw(img)
 
@@ -1393,6 +4646,10 @@ if __name__ == "__main__":
 
     font_small = font
 
+    if TEXT_ENGINE == "atlas":
+
+        glyph_atlas = GlyphAtlas(font)
+
     
 
     # ボタン初期化
@@ -1409,68 +4666,51 @@ if __name__ == "__main__":
 
     
 
+    # 表示スレッド(描画要求をまとめて描画・転送する)
+    display_thread = threading.Thread(target=render_pipeline.run)
+    display_thread.daemon = True
+    display_thread.start()
+
     # 初期表示
 
     update_display()
 
-    # keepalive with mpd
-    keep_alive_thread = threading.Thread(target=keep_alive_loop)
-    keep_alive_thread.daemon = True
-    keep_alive_thread.start()
-    
-    # 再生中画面の情報更新スレッド
-    now_playing_thread = threading.Thread(target=now_playing_update_loop)
-    now_playing_thread.daemon = True
-    now_playing_thread.start()
-    
-
-    # メインループ - 曲変更を検知して画面を更新
-    try:
-
-        current_song_id = None
-
-        while True:
-
-            # now_playing画面のときのみ曲変更を監視
-
-            if current_screen == "now_playing":
-
-                try:
-
-                    status = mpd_client.status()
-
-                    song_id = status.get('songid', None)
+    # タイマーで動く処理(再生中画面の更新、スクロール、ずれ補正、先読み)のスレッド
+    scheduler_thread = threading.Thread(target=scheduler.run)
+    scheduler_thread.daemon = True
+    scheduler_thread.start()
 
-                    
+    # MPDの変化を画面に反映
+    subscribe_mpd_events(("player", "playlist", "options"), handle_mpd_event)
+    subscribe_mpd_events(("database", "update", "stored_playlist"), invalidate_library_cache)
+    subscribe_mpd_events(("player", "playlist", "options"), prefetch_next_song)
+    subscribe_mpd_events(("database",), invalidate_album_art)
+    if SCREEN_WAKE_EVENTS:
+        subscribe_mpd_events(SCREEN_WAKE_EVENTS, wake_screen_on_event)
 
-                    # 曲が変更された場合に画面を更新
-
-                    if song_id != current_song_id:
-
-                        current_song_id = song_id
-
-                        update_display()
-
-                except Exception as e:
-
-                    print(f"Error in main loop: {e}")
-
-                
-
-                time.sleep(1)  # 0.5秒ごとに曲変更をチェック
-
-            else:
-
-                # now_playing画面以外では負荷軽減のため長めの待機
+    # ライブラリ索引(起動時とデータベース更新後に差分更新)
+    try:
+        library_index.open()
+        schedule_library_index_update()
+        subscribe_mpd_events(("database",), schedule_library_index_update)
+    except Exception as e:
+        print(f"Error opening library index: {e}")
+    
 
-                current_song_id = None  # 画面復帰時に確実に更新するためリセット
+    # メインループ - idleで曲変更などを待ち受けて画面を更新
+    try:
 
-                time.sleep(5)
+        mpd_idle_loop()
 
     except KeyboardInterrupt:
 
         print("\nShutting down...")
 
-        mpd_client.close()
+        mpd_client.print_metrics()
+
+        print(f"Display: {render_pipeline.requests} requests, {render_pipeline.renders} renders, "
+              f"{panel.bytes_sent // 1024} KB sent")
+
+        print(f"Scheduler: {scheduler.runs} job runs, {scheduler.wakeups} wakeups")
 
-        mpd_client.disconnect()
+        mpd_client.close_all()